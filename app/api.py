@@ -1,15 +1,204 @@
-from fastapi import FastAPI, UploadFile, File
+from typing import List
+
+from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
 import os
+import json
 import uuid
+import hashlib
+
+from celery import chain, group
+from celery.result import GroupResult
 
-from app.tasks import ocr_task
-from celery.result import AsyncResult
+# só o app Celery (produtor): nada de torch/EasyOCR no processo da API
+from app.celery_app import (
+    celery_app, OCR_TASK, OCR_BATCH_TASK, MATCH_TASK, MATCH_BATCH_TASK,
+    OCR_TASK_SUFFIX,
+)
+from app.ocr_store import has_ocr_result
+from app.log_utils import get_log
+from app.metrics import timed, render_metrics
+from app.job_events import JobEventHub, HEARTBEAT, state_of
 
 app = FastAPI()
 
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+
+# corpo inteiro da requisição (o lote tem vários arquivos). O Starlette
+# grava o multipart num arquivo temporário antes do endpoint rodar: este
+# limite é o que corta o envio enquanto ele chega. Em produção, configure
+# também o proxy (ex.: client_max_body_size do nginx)
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", 200 * 1024 * 1024))
+
+
+class BodyLimitMiddleware:
+    """
+    413 sem ler o corpo quando o Content-Length já passa do limite; sem
+    Content-Length (chunked), conta os bytes conforme chegam e interrompe
+    no limite — antes de o multipart ser gravado inteiro.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse(
+                {"detail": f"Requisição maior que {self.max_bytes} bytes"}, status_code=413
+            )
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(413, f"Requisição maior que {self.max_bytes} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(BodyLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+
+LONG_POLL_MAX_WAIT = float(os.environ.get("LONG_POLL_MAX_WAIT", 60))
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+
+# uma conexão pub/sub por processo, compartilhada por todos os waiters
+job_events = None
+
+
+@app.on_event("startup")
+async def start_job_events():
+    global job_events
+    job_events = JobEventHub()
+
+
+@app.on_event("shutdown")
+async def stop_job_events():
+    await job_events.close()
+
 UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/app/data/uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# documentos por task do lote: cada task faz um único match para todos
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", 8))
+
+# tipo do arquivo pelos primeiros bytes, não pela extensão do nome
+MAGIC_TYPES = [
+    (b"%PDF-", "pdf"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"BM", "bmp"),
+]
+# cabeçalho do BMP (BITMAPFILEHEADER) inteiro
+SNIFF_BYTES = 14
+
+
+def bmp_header_ok(head: bytes, size=None):
+    """
+    "BM" sozinho casa com qualquer texto que comece assim: exige os
+    campos reservados (bytes 6-9) zerados e, com o tamanho já conhecido,
+    o tamanho do arquivo declarado nos bytes 2-5.
+    """
+    if len(head) < SNIFF_BYTES or head[6:10] != b"\0\0\0\0":
+        return False
+    return size is None or int.from_bytes(head[2:6], "little") == size
+
+
+def sniff_type(head: bytes, size=None):
+    for magic, ext in MAGIC_TYPES:
+        if head.startswith(magic):
+            if ext == "bmp" and not bmp_header_ok(head, size):
+                return None
+            return ext
+    return None
+
+
+def _write_chunk(out, digest, chunk):
+    # hash + escrita fora do event loop
+    digest.update(chunk)
+    out.write(chunk)
+
+
+async def save_upload(file: UploadFile):
+    """
+    Grava o upload em disco em blocos, sem carregá-lo inteiro em memória.
+
+    O Starlette já gravou o corpo num arquivo temporário (spool do
+    multipart): aqui ele é copiado para UPLOAD_DIR e o MAX_UPLOAD_BYTES por
+    arquivo é verificado depois do envio. O corte durante o envio é o
+    MAX_REQUEST_BYTES (BodyLimitMiddleware) e o limite do proxy.
+
+    Calcula o sha256 durante a cópia e usa-o como nome do arquivo: o mesmo
+    conteúdo enviado de novo reaproveita o arquivo já existente.
+    Retorna (caminho, sha256, tipo, tamanho, já_existia).
+    """
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    ext = None
+
+    out = await run_in_threadpool(open, tmp_path, "wb")
+
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(413, f"Arquivo maior que {MAX_UPLOAD_BYTES} bytes")
+
+            if ext is None:
+                head += chunk[:SNIFF_BYTES]
+                if len(head) >= SNIFF_BYTES:
+                    ext = sniff_type(head)
+                    if ext is None:
+                        raise HTTPException(415, "Formato não suportado")
+
+            await run_in_threadpool(_write_chunk, out, digest, chunk)
+
+        if size == 0:
+            raise HTTPException(400, "Arquivo vazio")
+
+        # BMP: o tamanho declarado no cabeçalho só confere no fim
+        ext = sniff_type(head, size)
+        if ext is None:
+            raise HTTPException(415, "Formato não suportado")
+
+    except BaseException:
+        await run_in_threadpool(out.close)
+        await run_in_threadpool(os.remove, tmp_path)
+        raise
+
+    await run_in_threadpool(out.close)
+
+    sha256 = digest.hexdigest()
+    filepath = os.path.join(UPLOAD_DIR, f"{sha256}.{ext}")
+
+    existed = os.path.exists(filepath)
+    if existed:
+        await run_in_threadpool(os.remove, tmp_path)
+    else:
+        await run_in_threadpool(os.replace, tmp_path, filepath)
+
+    return filepath, sha256, ext, size, existed
+
 
 # ---------------------------
 # 1) Enviar arquivo
@@ -17,66 +206,279 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 @app.post("/ocr")
 async def process_file(file: UploadFile = File(...)):
 
-    filename = f"{uuid.uuid4()}_{file.filename}"
-    filepath = os.path.join(UPLOAD_DIR, filename)
+    with timed("upload_save"):
+        filepath, sha256, _, _, existed = await save_upload(file)
+
+    # OCR (fila ocr) → match (fila match); o job é a task de match
+    job_id = str(uuid.uuid4())
+
+    # publicar no broker é I/O bloqueante: fora do event loop
+    await run_in_threadpool(
+        chain(
+            celery_app.signature(OCR_TASK, args=[filepath]).set(
+                task_id=job_id + OCR_TASK_SUFFIX
+            ),
+            celery_app.signature(MATCH_TASK).set(task_id=job_id),
+        ).apply_async
+    )
+
+    return {
+        "job_id": job_id,
+        "status": "PROCESSING",
+        "sha256": sha256,
+        "duplicate": existed,
+    }
+
 
-    with open(filepath, "wb") as out:
-        out.write(await file.read())
+@app.post("/ocr/rematch/{document_id}")
+async def rematch(document_id: str):
+    """
+    Refaz só o match sobre o texto OCR já salvo (ex.: catálogo atualizado).
+    ``document_id`` é o sha256 devolvido no envio.
+    """
+    if not await run_in_threadpool(has_ocr_result, document_id):
+        raise HTTPException(404, "Texto OCR não encontrado")
 
-    task = ocr_task.delay(filepath)
+    task = await run_in_threadpool(
+        celery_app.send_task, MATCH_TASK, args=[{"document_id": document_id}]
+    )
 
     return {
         "job_id": task.id,
-        "status": "PROCESSING"
+        "status": "PROCESSING",
+        "document_id": document_id,
+    }
+
+
+# ---------------------------
+# 1b) Enviar lote de arquivos
+# ---------------------------
+@app.post("/ocr/batch")
+async def process_batch(files: List[UploadFile] = File(...)):
+    """
+    Vários arquivos de uma vez: um grupo do Celery com uma task a cada
+    BATCH_CHUNK_SIZE documentos, consultado por um único batch_id.
+    """
+    documents = []
+
+    for file in files:
+        with timed("upload_save"):
+            filepath, sha256, _, _, existed = await save_upload(file)
+        documents.append({
+            "filename": file.filename,
+            "path": filepath,
+            "sha256": sha256,
+            "duplicate": existed,
+        })
+
+    paths = [doc.pop("path") for doc in documents]
+    chunks = [
+        paths[i:i + BATCH_CHUNK_SIZE]
+        for i in range(0, len(paths), BATCH_CHUNK_SIZE)
+    ]
+
+    def submit():
+        result = group(
+            chain(
+                celery_app.signature(OCR_BATCH_TASK, args=(chunk,)),
+                celery_app.signature(MATCH_BATCH_TASK),
+            )
+            for chunk in chunks
+        ).apply_async()
+        result.save()  # permite GroupResult.restore(batch_id)
+        return result
+
+    result = await run_in_threadpool(submit)
+
+    return {
+        "batch_id": result.id,
+        "status": "PROCESSING",
+        "documents": documents,
+    }
+
+
+def batch_response(batch_id: str, result):
+    documents = []
+    completed = 0
+    failed = False
+
+    for task in result.results:
+        state = task.state
+
+        # o grupo só guarda as tasks de match: com o OCR do lote morto,
+        # o match nunca roda e fica PENDING — vale o estado do OCR
+        if state == "PENDING" and task.parent is not None:
+            if task.parent.state in ("FAILURE", "REVOKED"):
+                task = task.parent
+                state = task.state
+
+        if state == "SUCCESS":
+            completed += 1
+            documents.extend(task.result)
+        elif state in ("FAILURE", "REVOKED"):
+            completed += 1
+            failed = True
+            documents.append({
+                "job_id": task.id,
+                "status": "ERROR",
+                "error": str(task.result),
+            })
+
+    if completed < len(result.results):
+        status = "PROCESSING"
+    else:
+        status = "ERROR" if failed else "SUCCESS"
+
+    return {
+        "batch_id": batch_id,
+        "status": status,
+        "total": len(result.results),
+        "completed": completed,
+        "documents": documents,
     }
 
 
+@app.get("/ocr/batch/{batch_id}")
+async def get_batch_result(batch_id: str):
+
+    def restore():
+        result = GroupResult.restore(batch_id, app=celery_app)
+        if result is None:
+            return None
+        return batch_response(batch_id, result)
+
+    body = await run_in_threadpool(restore)
+
+    if body is None:
+        raise HTTPException(404, "Lote não encontrado")
+
+    return body
+
+
 # ---------------------------
 # 2) Buscar resultado
 # ---------------------------
-@app.get("/ocr/{job_id}")
-async def get_result(job_id: str):
+def _error_message(result):
+    # exceções chegam serializadas: {"exc_type", "exc_message", ...}
+    if isinstance(result, dict):
+        msg = result.get("exc_message")
+        if isinstance(msg, (list, tuple)):
+            msg = " ".join(str(m) for m in msg)
+        return str(msg)
+    return str(result)
 
-    result = AsyncResult(job_id)
 
-    if not result:
-        return {"error": "Job not found"}
+def job_response(job_id: str, meta):
+    status = state_of(meta)
 
-    if result.status == "PENDING":
+    if status == "PENDING":
         return {
             "job_id": job_id,
             "status": "PENDING"
         }
 
-    if result.status == "STARTED":
+    if status == "STARTED":
         return {
             "job_id": job_id,
             "status": "PROCESSING"
         }
 
-    if result.status == "FAILURE":
+    if status in ("FAILURE", "REVOKED"):
         return {
             "job_id": job_id,
             "status": "ERROR",
-            "error": str(result.result)
+            "error": _error_message(meta.get("result"))
         }
 
     # SUCCESS
-    data = result.result
+    data = meta.get("result") or {}
 
     return {
         "job_id": job_id,
         "status": "SUCCESS",
         "codes": data.get("codes"),
-        "text": data.get("text")
+        "catalog_version": data.get("catalog_version"),
+        "text": data.get("text"),
+        "timings": data.get("timings"),
     }
 
+
+async def ocr_stage_meta(job_id: str):
+    """
+    Match ainda PENDING: o job pode estar na etapa de OCR (task
+    ``<job_id>.ocr``) — em andamento ou já morta.
+    """
+    meta = await job_events.current(job_id + OCR_TASK_SUFFIX)
+    status = state_of(meta)
+
+    if status in ("FAILURE", "REVOKED"):
+        return meta
+    if status in ("STARTED", "SUCCESS"):
+        return {"status": "STARTED"}
+    return None
+
+
+@app.get("/ocr/{job_id}")
+async def get_result(job_id: str, wait: float = 0):
+    """
+    Sem ``wait``: estado atual. Com ``?wait=N`` (long-poll): segura a
+    conexão até o job mudar de estado ou N segundos passarem.
+    """
+    if wait > 0:
+        meta = await job_events.wait_update(job_id, min(wait, LONG_POLL_MAX_WAIT))
+    else:
+        meta = await job_events.current(job_id)
+
+    if meta is None:
+        meta = await ocr_stage_meta(job_id)
+
+    return job_response(job_id, meta)
+
+
+@app.get("/ocr/{job_id}/events")
+async def stream_result(job_id: str):
+    """Server-Sent Events: um evento a cada mudança de estado até terminar."""
+
+    async def events():
+        last = None
+        async for meta in job_events.stream(job_id, SSE_HEARTBEAT):
+            if meta is HEARTBEAT or meta is None:
+                # match ainda não começou: consulta a etapa de OCR
+                stage = await ocr_stage_meta(job_id)
+
+                if meta is HEARTBEAT:
+                    yield ": keep-alive\n\n"
+                    if stage is None:
+                        continue
+
+                meta = stage
+
+            body = job_response(job_id, meta)
+            if body != last:
+                yield f"event: status\ndata: {json.dumps(body, ensure_ascii=False)}\n\n"
+                last = body
+
+            # OCR morreu: a task de match nunca vai rodar
+            if body["status"] == "ERROR":
+                break
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/ocr/log/{job_id}")
-def get_log(job_id: str):
-    path = f"/app/data/logs/{job_id}.json"
+def get_job_log(job_id: str):
+    payload = get_log(job_id)
 
-    if not os.path.exists(path):
+    if payload is None:
         raise HTTPException(404, "Log não encontrado")
 
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return payload
+
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
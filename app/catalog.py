@@ -0,0 +1,261 @@
+import io
+import os
+import csv
+import json
+import struct
+import unicodedata
+
+import numpy as np
+
+# =========================================================
+# Catálogo compacto de procedimentos
+#
+# Linhas deduplicadas por (código, descrição normalizada). Códigos ficam
+# num array de largura fixa e as descrições em um único blob UTF-8 com
+# offsets — nada de listas de tuplas/dicts por linha. O arquivo binário
+# é aberto via mmap e os arrays são apenas views sobre ele.
+#
+# Layout do arquivo:
+#   MAGIC (8 bytes) | tamanho do header (uint64 LE) | header JSON
+#   | arrays alinhados em ALIGN bytes
+# =========================================================
+MAGIC = b"PCATv1\0\0"
+ALIGN = 64
+
+
+def normalize_text(s: str):
+    """Minúsculas, sem acentos e com espaços colapsados."""
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return " ".join(s.casefold().split())
+
+
+# =========================================================
+# Leitura robusta do CSV — encoding + delimitador detectados
+# =========================================================
+def read_procedures_csv(csv_path: str):
+    with open(csv_path, "rb") as f:
+        raw = f.read()
+
+    for enc in ("utf-8-sig", "cp1252", "latin-1"):
+        try:
+            text = raw.decode(enc)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        # fallback extremo (nunca quebra)
+        text = raw.decode("latin-1", errors="replace")
+
+    sample = text[:2048]
+    delimiter = ";" if sample.count(";") > sample.count(",") else ","
+
+    records = []
+
+    for row in csv.DictReader(io.StringIO(text), delimiter=delimiter):
+        code = (
+            row.get("CODIGO")
+            or row.get("codigo")
+            or row.get("code")
+            or row.get("cod")
+        )
+        desc = (
+            row.get("DESCRICAO")
+            or row.get("descricao")
+            or row.get("description")
+            or ""
+        )
+
+        if code and desc:
+            records.append((str(code).strip(), desc.strip()))
+
+    if not records:
+        raise RuntimeError(f"Nenhum procedimento carregado do CSV {csv_path}")
+
+    return records
+
+
+def _pack_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class ProcedureCatalog:
+
+    def __init__(self, arrays):
+        self.codes = arrays["codes"]
+        self.sorted_codes = arrays["sorted_codes"]
+        self.sorted_rows = arrays["sorted_rows"]
+        self.desc_offsets = arrays["desc_offsets"]
+        self.desc_blob = arrays["desc_blob"]
+        self.norm_offsets = arrays["norm_offsets"]
+        self.norm_blob = arrays["norm_blob"]
+
+    # ======================================================
+    # Construção
+    # ======================================================
+    @classmethod
+    def from_records(cls, records):
+        seen = set()
+        codes, descs, norms = [], [], []
+
+        for code, desc in records:
+            norm = normalize_text(desc)
+            key = (code, norm)
+
+            # duplicatas exatas (ou que só diferem em caixa/acentos) saem aqui
+            if key in seen:
+                continue
+            seen.add(key)
+
+            codes.append(code)
+            descs.append(desc)
+            norms.append(norm)
+
+        code_arr = np.array([c.encode("utf-8") for c in codes])
+        order = np.argsort(code_arr, kind="stable").astype(np.int32)
+
+        desc_offsets, desc_blob = _pack_strings(descs)
+        norm_offsets, norm_blob = _pack_strings(norms)
+
+        return cls({
+            "codes": code_arr,
+            "sorted_codes": code_arr[order],
+            "sorted_rows": order,
+            "desc_offsets": desc_offsets,
+            "desc_blob": desc_blob,
+            "norm_offsets": norm_offsets,
+            "norm_blob": norm_blob,
+        })
+
+    @classmethod
+    def from_csv(cls, csv_path: str):
+        return cls.from_records(read_procedures_csv(csv_path))
+
+    # ======================================================
+    # Serialização binária (carga via mmap, sem objetos por linha)
+    # ======================================================
+    def _arrays(self):
+        return {
+            "codes": self.codes,
+            "sorted_codes": self.sorted_codes,
+            "sorted_rows": self.sorted_rows,
+            "desc_offsets": self.desc_offsets,
+            "desc_blob": self.desc_blob,
+            "norm_offsets": self.norm_offsets,
+            "norm_blob": self.norm_blob,
+        }
+
+    def write(self, f):
+        arrays = self._arrays()
+
+        layout = {}
+        offset = 0
+        for name, arr in arrays.items():
+            layout[name] = {
+                "dtype": arr.dtype.str,
+                "shape": list(arr.shape),
+                "offset": offset,
+            }
+            offset += -(-arr.nbytes // ALIGN) * ALIGN
+
+        header = json.dumps({"count": len(self), "arrays": layout}).encode("utf-8")
+        start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(b"\0" * (start - len(MAGIC) - 8 - len(header)))
+
+        for name, arr in arrays.items():
+            data = np.ascontiguousarray(arr).tobytes()
+            f.write(data)
+            f.write(b"\0" * (-(-len(data) // ALIGN) * ALIGN - len(data)))
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            self.write(f)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Abre o arquivo via mmap. Versão diferente (MAGIC) ou arquivo
+        truncado → ValueError: quem carrega reconstrói a partir do CSV.
+        """
+        if os.path.getsize(path) < len(MAGIC) + 8:
+            raise ValueError(f"Arquivo de catálogo truncado: {path}")
+
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"Arquivo de catálogo inválido: {path}")
+
+        (header_len,) = struct.unpack("<Q", bytes(buf[len(MAGIC):len(MAGIC) + 8]))
+        header_end = len(MAGIC) + 8 + header_len
+        if header_end > len(buf):
+            raise ValueError(f"Arquivo de catálogo truncado: {path}")
+
+        header = json.loads(bytes(buf[len(MAGIC) + 8:header_end]).decode("utf-8"))
+        start = -(-header_end // ALIGN) * ALIGN
+
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"], dtype=np.int64))
+            offset = start + spec["offset"]
+
+            if offset + count * dtype.itemsize > len(buf):
+                raise ValueError(f"Arquivo de catálogo truncado: {path}")
+
+            arrays[name] = np.frombuffer(
+                buf, dtype=dtype, count=count, offset=offset
+            ).reshape(spec["shape"])
+
+        return cls(arrays)
+
+    # ======================================================
+    # Acesso
+    # ======================================================
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, i):
+        return self.code(i), self.desc(i)
+
+    def code(self, i):
+        return self.codes[i].decode("utf-8")
+
+    def desc(self, i):
+        o = self.desc_offsets
+        return self.desc_blob[o[i]:o[i + 1]].tobytes().decode("utf-8")
+
+    def norm_desc(self, i):
+        o = self.norm_offsets
+        return self.norm_blob[o[i]:o[i + 1]].tobytes().decode("utf-8")
+
+    def descs(self):
+        return [self.desc(i) for i in range(len(self))]
+
+    def _find(self, code: str):
+        key = code.encode("utf-8")
+
+        if len(key) > self.sorted_codes.dtype.itemsize:
+            return -1
+
+        pos = int(np.searchsorted(self.sorted_codes, key))
+
+        if pos < len(self.sorted_codes) and self.sorted_codes[pos] == key:
+            return int(self.sorted_rows[pos])
+
+        return -1
+
+    def has_code(self, code: str):
+        return self._find(code) >= 0
+
+    def desc_for_code(self, code: str):
+        row = self._find(code)
+        return self.desc(row) if row >= 0 else None
@@ -0,0 +1,63 @@
+import os
+import time
+
+from celery import Celery
+from celery.signals import before_task_publish
+
+# =========================================================
+# App Celery sem dependências de ML.
+#
+# A API só publica tasks (por nome) e lê resultados: importa este
+# módulo, nunca app.tasks — assim o uvicorn não carrega torch,
+# EasyOCR nem o modelo de embeddings. As tasks em si ficam em
+# app.tasks, carregado apenas pelo worker.
+# =========================================================
+
+BROKER = os.environ.get("CELERY_BROKER_URL", "redis://ocr_redis:6379/0")
+BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://ocr_redis:6379/1")
+
+# nomes registrados em app.tasks
+OCR_TASK = "app.tasks.ocr_task"
+OCR_BATCH_TASK = "app.tasks.ocr_batch_task"
+MATCH_TASK = "app.tasks.match_task"
+MATCH_BATCH_TASK = "app.tasks.match_batch_task"
+
+# filas separadas: poucos workers grandes de OCR, vários workers leves
+# de match — cada um escala por conta própria
+OCR_QUEUE = os.environ.get("OCR_QUEUE", "ocr")
+MATCH_QUEUE = os.environ.get("MATCH_QUEUE", "match")
+
+# id da task de OCR de um job: a de match usa o próprio job_id
+OCR_TASK_SUFFIX = ".ocr"
+
+# segundos que o pai do prefork espera o filho terminar o
+# worker_process_init antes de matá-lo. O warm-up (app.tasks) roda ali:
+# sessões ONNX e primeira inferência do EasyOCR/modelo — sem preload,
+# também carrega todos os modelos. O padrão do Celery (4 s) não cobre e
+# o pai fica matando e recriando os filhos
+WORKER_PROC_ALIVE_TIMEOUT = float(os.environ.get("WORKER_PROC_ALIVE_TIMEOUT", 300))
+
+celery_app = Celery("tasks", broker=BROKER, backend=BACKEND)
+
+# publica STARTED no backend — usado pelo long-poll/SSE da API
+celery_app.conf.task_track_started = True
+
+celery_app.conf.task_routes = {
+    OCR_TASK: {"queue": OCR_QUEUE},
+    OCR_BATCH_TASK: {"queue": OCR_QUEUE},
+    MATCH_TASK: {"queue": MATCH_QUEUE},
+    MATCH_BATCH_TASK: {"queue": MATCH_QUEUE},
+}
+
+# tasks longas (OCR): cada processo reserva só a task que vai executar,
+# sem segurar mensagens enquanto outro processo está ocioso
+celery_app.conf.worker_prefetch_multiplier = 1
+
+celery_app.conf.worker_proc_alive_timeout = WORKER_PROC_ALIVE_TIMEOUT
+
+
+@before_task_publish.connect
+def stamp_sent_at(headers=None, **kwargs):
+    # lido pelo worker como task.request.sent_at — tempo de fila
+    if headers is not None:
+        headers.setdefault("sent_at", time.time())
@@ -1,39 +1,299 @@
 import os
-import pickle
+import json
+import time
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
-INDEX_DIR = "/app/data/vector_index"
+from app.catalog import ProcedureCatalog
+from app.encoder import get_encoder
+
+INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "/app/data/vector_index")
+INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "flat")  # flat | hnsw
+EF_SEARCH = int(os.environ.get("VECTOR_INDEX_EF_SEARCH", "64"))
 THRESHOLD = float(os.environ.get("EMBEDDING_THRESHOLD", "0.75"))
 
+# =========================================================
+# Formato do artefato (um diretório, produzido pelo script
+# scripts/build_procedure_index.py ou pelo próprio matcher):
+#
+#   manifest.json         modelo (+ backend), hash do CSV, contagem, dimensão
+#   catalog.bin           catálogo deduplicado (app/catalog.py), na ordem do índice
+#   embeddings.npy        matriz float32 normalizada (aberta via mmap)
+#   procedures.index      HNSW (produto interno) sobre a mesma matriz
+# =========================================================
+MANIFEST_FILE = "manifest.json"
+CATALOG_FILE = "catalog.bin"
+EMB_FILE = "embeddings.npy"
+HNSW_FILE = "procedures.index"
+LOCK_FILE = ".build.lock"
+
+FORMAT_VERSION = 2
+
+
+class FlatIPIndex:
+    """
+    Busca exata por produto interno direto sobre a matriz de embeddings.
+
+    Mesmo contrato de ``faiss.IndexFlatIP.search``, mas sem copiar a
+    matriz para dentro do índice: com a matriz aberta via mmap, todos os
+    processos do host leem as mesmas páginas do page cache.
+    """
+
+    def __init__(self, emb):
+        self.emb = emb
+        self.ntotal = emb.shape[0]
+
+    def search(self, queries, k):
+        scores = np.asarray(queries @ self.emb.T)
+
+        if k == 1:
+            idx = scores.argmax(axis=1)[:, None]
+        else:
+            idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+            idx = np.take_along_axis(idx, order, axis=1)
+
+        return np.take_along_axis(scores, idx, axis=1), idx
+
+
+def file_sha256(path: str):
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+@contextmanager
+def _build_lock(index_dir: str):
+    # serializa build/carga entre processos (vários workers no mesmo host)
+    os.makedirs(index_dir, exist_ok=True)
+
+    with open(os.path.join(index_dir, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _replace_atomic(path: str, write):
+    tmp = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp, "wb") as f:
+        write(f)
+
+    os.replace(tmp, path)
+
+
+def load_manifest(index_dir: str = INDEX_DIR):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_stale(manifest, csv_sha256: str, model_name: str):
+    return (
+        manifest is None
+        or manifest.get("format") != FORMAT_VERSION
+        or manifest.get("model") != model_name
+        or manifest.get("csv_sha256") != csv_sha256
+    )
+
+
+def catalog_version(manifest, index_type: str = INDEX_TYPE):
+    """Identifica catálogo + modelo + índice: muda a cada rebuild com CSV novo."""
+    key = json.dumps(
+        [manifest.get("format"), manifest.get("model"), manifest.get("csv_sha256"), index_type]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _previous_embeddings(index_dir: str, model_name: str):
+    """
+    Embeddings do artefato anterior, indexados pela descrição.
+    Só reaproveitamos se o modelo (e o backend — ``encoder.id``) for o mesmo.
+    """
+    manifest = load_manifest(index_dir)
+
+    if manifest is None or manifest.get("model") != model_name:
+        return {}, None
+
+    try:
+        catalog = ProcedureCatalog.load(os.path.join(index_dir, CATALOG_FILE))
+        emb = np.load(os.path.join(index_dir, EMB_FILE), mmap_mode="r")
+    except (OSError, ValueError):
+        return {}, None
+
+    if len(catalog) != emb.shape[0]:
+        return {}, None
+
+    return {desc: i for i, desc in enumerate(catalog.descs())}, emb
+
+
+# =========================================================
+# Build incremental — só as linhas novas/editadas são codificadas
+# =========================================================
+def build_index(csv_path, encoder, index_dir=INDEX_DIR, batch_size=64, full=False,
+                log=print):
+    with _build_lock(index_dir):
+        return _build_index(csv_path, encoder, index_dir, batch_size, full, log)
+
+
+def _build_index(csv_path, encoder, index_dir, batch_size, full, log):
+    model_name = encoder.id
+
+    catalog = ProcedureCatalog.from_csv(csv_path)
+    descs = catalog.descs()
+    csv_sha256 = file_sha256(csv_path)
+
+    old_rows, old_emb = ({}, None) if full else _previous_embeddings(index_dir, model_name)
+
+    reuse_new, reuse_old, missing = [], [], []
+
+    for i, desc in enumerate(descs):
+        j = old_rows.get(desc)
+        if j is None:
+            missing.append(i)
+        else:
+            reuse_new.append(i)
+            reuse_old.append(j)
+
+    log(f"{len(catalog)} procedimentos (deduplicados): {len(reuse_new)} reaproveitados, "
+        f"{len(missing)} para codificar")
+
+    new_emb = None
+    if missing:
+        new_emb = encoder.encode(
+            [descs[i] for i in missing],
+            batch_size=batch_size,
+            normalize=True,
+            show_progress_bar=len(missing) > 1000,
+        )
+
+    dim = new_emb.shape[1] if new_emb is not None else old_emb.shape[1]
+
+    emb = np.empty((len(catalog), dim), dtype="float32")
+    if reuse_new:
+        emb[reuse_new] = old_emb[reuse_old]
+    if missing:
+        emb[missing] = new_emb
+
+    log("Building FAISS HNSW index...")
+    hnsw = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    hnsw.hnsw.efConstruction = 200
+    hnsw.add(emb)
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "model": model_name,
+        "csv_sha256": csv_sha256,
+        "count": len(catalog),
+        "dim": dim,
+        "encoded": len(missing),
+        "reused": len(reuse_new),
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+    # manifest por último: só aponta para o novo artefato quando
+    # todos os outros arquivos já foram trocados
+    _replace_atomic(os.path.join(index_dir, EMB_FILE), lambda f: np.save(f, emb))
+    _replace_atomic(os.path.join(index_dir, CATALOG_FILE), catalog.write)
+    _replace_atomic(
+        os.path.join(index_dir, HNSW_FILE),
+        lambda f: f.write(faiss.serialize_index(hnsw).tobytes())
+    )
+    _replace_atomic(
+        os.path.join(index_dir, MANIFEST_FILE),
+        lambda f: f.write(json.dumps(manifest, indent=2).encode("utf-8"))
+    )
+
+    return manifest
+
+
+def load_index(index_dir=INDEX_DIR, index_type=INDEX_TYPE):
+    """
+    Retorna (catalog, embeddings, index). Catálogo e embeddings vêm via
+    mmap; ``index`` é a busca exata sobre a matriz (flat) ou o HNSW gravado.
+    """
+    catalog = ProcedureCatalog.load(os.path.join(index_dir, CATALOG_FILE))
+
+    emb = np.load(os.path.join(index_dir, EMB_FILE), mmap_mode="r")
+
+    if len(catalog) != emb.shape[0]:
+        raise RuntimeError(
+            f"Artefato inconsistente em {index_dir}: "
+            f"{len(catalog)} procedimentos x {emb.shape[0]} embeddings"
+        )
+
+    if index_type == "hnsw":
+        index = faiss.read_index(os.path.join(index_dir, HNSW_FILE))
+        index.hnsw.efSearch = EF_SEARCH
+    elif index_type == "flat":
+        index = FlatIPIndex(emb)
+    else:
+        raise ValueError(f"VECTOR_INDEX_TYPE inválido: {index_type}")
+
+    return catalog, emb, index
+
+
+def load_or_build_index(csv_path, encoder, index_dir=INDEX_DIR, index_type=INDEX_TYPE,
+                        batch_size=64):
+    """
+    Usado pelo matcher: carrega o artefato se ele corresponde ao CSV e ao
+    encoder atuais; caso contrário reconstrói (incrementalmente) antes.
+    Retorna (catalog, embeddings, index, manifest).
+    """
+    csv_sha256 = file_sha256(csv_path)
+
+    with _build_lock(index_dir):
+        manifest = load_manifest(index_dir)
+        if is_stale(manifest, csv_sha256, encoder.id):
+            manifest = _build_index(csv_path, encoder, index_dir, batch_size,
+                                    full=False, log=lambda msg: None)
+
+        return (*load_index(index_dir, index_type), manifest)
+
+
 class ProcedureEmbeddingIndex:
 
-    def __init__(self):
-        self.model = SentenceTransformer(MODEL_NAME)
-        self.index = faiss.read_index(f"{INDEX_DIR}/procedures.index")
+    def __init__(self, index_dir: str = INDEX_DIR):
+        self.encoder = get_encoder()
 
-        with open(f"{INDEX_DIR}/procedures_meta.pkl", "rb") as f:
-            self.meta = pickle.load(f)
+        if load_manifest(index_dir) is None:
+            raise RuntimeError(
+                f"Índice não encontrado em {index_dir}. "
+                "Rode scripts/build_procedure_index.py"
+            )
+
+        self.catalog, self.emb, self.index = load_index(index_dir, "hnsw")
 
     def query(self, text: str, top_k: int = 5):
-        emb = self.model.encode(
-            [text],
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        ).astype("float32")
+        emb = self.encoder.encode([text], normalize=True)
 
-        distances, indices = self.index.search(emb, top_k)
+        scores, indices = self.index.search(emb, top_k)
 
         results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            score = 1 - float(dist)  # HNSWFlat retorna distância L2
+        for score, idx in zip(scores[0], indices[0]):
+            if idx < 0:
+                continue
+
+            score = float(score)  # produto interno = cosseno (vetores normalizados)
             if score >= THRESHOLD:
-                proc = self.meta[idx]
+                code, desc = self.catalog[idx]
                 results.append({
-                    "code": proc["code"],
-                    "description": proc["desc"],
+                    "code": code,
+                    "description": desc,
                     "score": score
                 })
 
@@ -0,0 +1,264 @@
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+
+# nome único do modelo — usado pelo matcher, pelo índice e pelo script de build
+MODEL_NAME = os.environ.get("EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2")
+
+# torch (SentenceTransformer fp32) | onnx (ONNX Runtime fp32) | onnx-int8
+# (ONNX Runtime com quantização dinâmica int8 dos pesos)
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+
+# modelo exportado para ONNX (+ tokenizer), gerado no primeiro uso
+ONNX_DIR = os.environ.get("EMBEDDING_ONNX_DIR", os.path.join(DATA_DIR, "onnx"))
+
+# all-mpnet-base-v2 trunca em 384 tokens (max_seq_length do SentenceTransformer)
+MAX_SEQ_LENGTH = int(os.environ.get("EMBEDDING_MAX_SEQ_LENGTH", 384))
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+
+# threads do ONNX Runtime; 0 = padrão do ORT (todos os núcleos)
+_num_threads = 0
+
+
+def set_num_threads(n: int):
+    """Vale para sessões ONNX criadas depois (o worker chama por filho)."""
+    global _num_threads
+    _num_threads = n
+
+
+def session_options():
+    """SessionOptions do ONNX Runtime com as threads do processo."""
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    if _num_threads:
+        opts.intra_op_num_threads = _num_threads
+        opts.inter_op_num_threads = 1
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return opts
+
+
+def _normalize(emb):
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    return emb / np.maximum(norms, 1e-12)
+
+
+class TorchEncoder:
+    """SentenceTransformer em PyTorch fp32 — o comportamento original."""
+
+    backend = "torch"
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+
+    @property
+    def id(self):
+        # mantém o nome puro: artefatos antigos (só torch) continuam válidos
+        return self.model_name
+
+    def encode(self, texts, batch_size: int = 64, normalize: bool = True,
+               show_progress_bar: bool = False):
+        return self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=normalize,
+            show_progress_bar=show_progress_bar,
+        ).astype("float32")
+
+
+class OnnxEncoder:
+    """
+    Mesmo modelo via ONNX Runtime: transformer exportado + mean pooling
+    e normalização em numpy (o pipeline do SentenceTransformer).
+
+    Com ``quantized``, os pesos das camadas lineares são quantizados para
+    int8 (quantização dinâmica) — várias vezes mais rápido em CPU, com
+    embeddings muito próximos dos fp32.
+
+    A sessão é criada por processo, no primeiro uso: o thread pool do ORT
+    não sobrevive a um fork (prefork), então o pai só exporta/quantiza.
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, quantized: bool = False,
+                 onnx_dir: str = ONNX_DIR):
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.quantized = quantized
+        self.backend = "onnx-int8" if quantized else "onnx"
+        self.model_dir = os.path.join(onnx_dir, model_name.replace("/", "__"))
+
+        self.model_path = ensure_onnx_model(model_name, self.model_dir, quantized)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return f"{self.model_name}@{self.backend}"
+
+    def _get_session(self):
+        pid = os.getpid()
+        if self._session_pid != pid:
+            with self._lock:
+                if self._session_pid != pid:
+                    import onnxruntime as ort
+
+                    self._session = ort.InferenceSession(
+                        self.model_path, session_options(), providers=["CPUExecutionProvider"]
+                    )
+                    self._inputs = {i.name for i in self._session.get_inputs()}
+                    self._session_pid = pid
+        return self._session
+
+    def encode(self, texts, batch_size: int = 64, normalize: bool = True,
+               show_progress_bar: bool = False):
+        session = self._get_session()
+
+        texts = list(texts)
+        out = None
+
+        # ordena por tamanho: cada lote tem pouco padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+
+            tokens = self.tokenizer(
+                [texts[i] for i in idx],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            feed = {k: v.astype(np.int64) for k, v in tokens.items() if k in self._inputs}
+
+            hidden = session.run(None, feed)[0]
+
+            # mean pooling sobre os tokens reais
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+            if out is None:
+                out = np.empty((len(texts), emb.shape[1]), dtype=np.float32)
+            out[idx] = emb
+
+        if out is None:
+            return np.empty((0, 0), dtype=np.float32)
+
+        return _normalize(out) if normalize else out
+
+
+# =========================================================
+# Exportação ONNX (uma vez por host; precisa de torch)
+# =========================================================
+@contextmanager
+def export_lock(model_dir: str):
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, ".export.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def export_onnx(model_name: str, model_dir: str):
+    """Transformer do modelo → model.onnx (eixos dinâmicos) + tokenizer."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["exemplo"], return_tensors="pt")
+    names = [k for k in ("input_ids", "attention_mask", "token_type_ids") if k in sample]
+    axes = {k: {0: "batch", 1: "seq"} for k in names}
+    axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+
+    tmp = os.path.join(model_dir, f"tmp.{os.getpid()}.{ONNX_FILE}")
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[k] for k in names),
+            tmp,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=axes,
+            opset_version=14,
+        )
+
+    tokenizer.save_pretrained(model_dir)
+    os.replace(tmp, os.path.join(model_dir, ONNX_FILE))
+
+
+def quantize_onnx(model_dir: str):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    tmp = os.path.join(model_dir, f"tmp.{os.getpid()}.{ONNX_INT8_FILE}")
+    quantize_dynamic(
+        os.path.join(model_dir, ONNX_FILE),
+        tmp,
+        weight_type=QuantType.QInt8,
+    )
+    os.replace(tmp, os.path.join(model_dir, ONNX_INT8_FILE))
+
+
+def ensure_onnx_model(model_name: str, model_dir: str, quantized: bool):
+    path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+
+    if os.path.exists(path):
+        return path
+
+    # vários workers subindo juntos: só um exporta
+    with export_lock(model_dir):
+        if not os.path.exists(os.path.join(model_dir, ONNX_FILE)):
+            export_onnx(model_name, model_dir)
+        if quantized and not os.path.exists(path):
+            quantize_onnx(model_dir)
+
+    return path
+
+
+# =========================================================
+# Fábrica
+# =========================================================
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def get_encoder(backend: str = None, model_name: str = MODEL_NAME):
+    """Encoder do processo para (modelo, backend); EMBEDDING_BACKEND por padrão."""
+    backend = backend or EMBEDDING_BACKEND
+
+    if backend not in BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND inválido: {backend} (use {', '.join(BACKENDS)})")
+
+    key = (model_name, backend)
+
+    with _encoders_lock:
+        encoder = _encoders.get(key)
+        if encoder is None:
+            if backend == "torch":
+                encoder = TorchEncoder(model_name)
+            else:
+                encoder = OnnxEncoder(model_name, quantized=backend == "onnx-int8")
+            _encoders[key] = encoder
+
+    return encoder
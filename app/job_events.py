@@ -0,0 +1,143 @@
+import os
+import json
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import redis
+import redis.asyncio as aioredis
+
+RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://ocr_redis:6379/1")
+
+# chave/canal do backend Redis do Celery: a cada mudança de estado ele faz
+# SET celery-task-meta-<id> e PUBLISH no canal de mesmo nome
+META_PREFIX = "celery-task-meta-"
+
+TERMINAL_STATES = {"SUCCESS", "FAILURE", "REVOKED"}
+
+# gerado por stream() quando nada mudou dentro do intervalo de heartbeat
+HEARTBEAT = object()
+
+log = logging.getLogger(__name__)
+
+
+class JobEventHub:
+    """
+    Espera mudanças de estado de tasks do Celery sem polling.
+
+    Uma única conexão pub/sub por processo; cada waiter é só uma
+    ``asyncio.Queue``. Vários waiters do mesmo job compartilham uma
+    inscrição no canal, desfeita quando o último sai.
+    """
+
+    def __init__(self, url: str = RESULT_BACKEND):
+        self.redis = aioredis.from_url(url)
+        self.pubsub = self.redis.pubsub()
+        self._waiters = {}
+        self._lock = asyncio.Lock()
+        self._reader = None
+
+    async def current(self, job_id: str):
+        """Meta atual do job (dict) ou None se ainda PENDING."""
+        raw = await self.redis.get(META_PREFIX + job_id)
+        return json.loads(raw) if raw else None
+
+    @asynccontextmanager
+    async def subscribe(self, job_id: str):
+        channel = META_PREFIX + job_id
+        queue = asyncio.Queue()
+
+        async with self._lock:
+            waiters = self._waiters.get(channel)
+            if waiters is None:
+                await self.pubsub.subscribe(channel)
+                waiters = self._waiters[channel] = set()
+            waiters.add(queue)
+
+            if self._reader is None:
+                self._reader = asyncio.create_task(self._read_loop())
+
+        try:
+            yield queue
+        finally:
+            async with self._lock:
+                waiters.discard(queue)
+                if not waiters:
+                    self._waiters.pop(channel, None)
+                    await self.pubsub.unsubscribe(channel)
+
+    async def _read_loop(self):
+        while True:
+            if not self._waiters:
+                await asyncio.sleep(0.1)
+                continue
+
+            try:
+                msg = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                log.warning("pub/sub de jobs desconectado: %s", e)
+                await asyncio.sleep(1.0)
+                continue
+            except Exception:
+                # o leitor nunca pode morrer: todos os waiters dependem dele
+                log.exception("erro lendo pub/sub de jobs")
+                await asyncio.sleep(1.0)
+                continue
+
+            if msg is None or msg.get("type") != "message":
+                continue
+
+            channel = msg["channel"].decode()
+
+            try:
+                meta = json.loads(msg["data"])
+            except ValueError:
+                continue
+
+            for queue in self._waiters.get(channel, ()):
+                queue.put_nowait(meta)
+
+    async def wait_update(self, job_id: str, timeout: float):
+        """
+        Long-poll: retorna a meta assim que o job mudar de estado (ou a
+        atual, se já terminou ou se ``timeout`` segundos passarem).
+        """
+        async with self.subscribe(job_id) as queue:
+            # lido depois da inscrição: nenhuma transição escapa
+            meta = await self.current(job_id)
+            if state_of(meta) in TERMINAL_STATES:
+                return meta
+
+            try:
+                return await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return meta
+
+    async def stream(self, job_id: str, heartbeat: float):
+        """
+        Gera a meta a cada mudança de estado até o job terminar; gera
+        HEARTBEAT a cada ``heartbeat`` segundos sem novidade (keep-alive).
+        """
+        async with self.subscribe(job_id) as queue:
+            meta = await self.current(job_id)
+            yield meta
+
+            while state_of(meta) not in TERMINAL_STATES:
+                try:
+                    meta = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+                yield meta
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.pubsub.close()
+        await self.redis.close()
+
+
+def state_of(meta):
+    return meta["status"] if meta else "PENDING"
@@ -0,0 +1,188 @@
+import os
+import re
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+FUZZY_THRESHOLD = float(os.environ.get("MATCHER_FUZZY_THRESHOLD", 90))
+FUZZY_MIN_LEN = int(os.environ.get("MATCHER_FUZZY_MIN_LEN", 6))
+
+# sufixos genéricos da tabela — "T4 livre - pesquisa e/ou dosagem" deve
+# casar com a linha "T4 Livre" sem precisar do modelo
+BOILERPLATE_SUFFIX = re.compile(
+    r"\s*[-,]\s*(pesquisa e/ou dosagem|pesquisa|dosagem)$"
+)
+
+# sigla definida na própria descrição: "Tiroxina (T4) - ..."
+ACRONYM = re.compile(r"\((\w{2,6})\)")
+
+EMPTY_ROWS = np.empty(0, dtype=np.int32)
+
+_AMBIGUOUS = -1
+
+
+def has_digit(s: str):
+    return any(ch.isdigit() for ch in s)
+
+
+def _compatible(norm_line: str, key: str):
+    """
+    Erro de OCR só é tolerado dentro de palavras longas: siglas e tokens
+    curtos ou com dígitos carregam o significado (T3 x T4, vitamina A x D)
+    e precisam ser idênticos.
+    """
+    a, b = norm_line.split(), key.split()
+
+    if len(a) != len(b):
+        return False
+
+    return all(
+        x == y
+        for x, y in zip(a, b)
+        if len(x) <= 3 or len(y) <= 3 or has_digit(x) or has_digit(y)
+    )
+
+
+def description_keys(norm_desc: str):
+    keys = {norm_desc}
+
+    core = BOILERPLATE_SUFFIX.sub("", norm_desc).strip()
+    if core:
+        keys.add(core)
+
+    return keys
+
+
+class LexicalIndex:
+    """
+    Atalho léxico antes do modelo de embeddings.
+
+    ``exact`` é um dict de descrição normalizada (e sua forma sem sufixo
+    genérico) → linha do catálogo; ``fuzzy`` usa rapidfuzz sobre as mesmas
+    chaves para absorver pequenos erros de OCR. Chaves que apontam para
+    códigos diferentes são marcadas como ambíguas e nunca resolvem aqui.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._exact = {}
+
+        for i in range(len(catalog)):
+            for key in description_keys(catalog.norm_desc(i)):
+                if len(key) < 3 or not any(ch.isalpha() for ch in key):
+                    continue
+
+                row = self._exact.get(key)
+                if row is None:
+                    self._exact[key] = i
+                elif row != _AMBIGUOUS and catalog.code(row) != catalog.code(i):
+                    self._exact[key] = _AMBIGUOUS
+
+        self._choices = [k for k, row in self._exact.items() if row != _AMBIGUOUS]
+        self._rows = [self._exact[k] for k in self._choices]
+
+    def exact(self, norm_line: str):
+        row = self._exact.get(norm_line)
+        return None if row is None or row == _AMBIGUOUS else row
+
+    def fuzzy(self, norm_line: str, threshold: float = FUZZY_THRESHOLD):
+        """Retorna (linha, score 0-1) ou None se não houver vencedor claro."""
+        if len(norm_line) < FUZZY_MIN_LEN:
+            return None
+
+        hits = process.extract(
+            norm_line,
+            self._choices,
+            scorer=fuzz.ratio,
+            score_cutoff=threshold,
+            limit=10,
+        )
+
+        hits = [h for h in hits if _compatible(norm_line, h[0])]
+
+        if not hits:
+            return None
+
+        _, best_score, best_pos = hits[0]
+        best_row = self._rows[best_pos]
+
+        # empate entre códigos diferentes → deixa para os embeddings
+        if len(hits) > 1:
+            _, second_score, second_pos = hits[1]
+            second_row = self._rows[second_pos]
+            if (
+                second_score == best_score
+                and self.catalog.code(second_row) != self.catalog.code(best_row)
+            ):
+                return None
+
+        return best_row, best_score / 100.0
+
+
+def trigrams(s: str):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class PhraseIndex:
+    """
+    Índice invertido de trigramas sobre as descrições normalizadas.
+
+    ``containing`` responde "quais descrições contêm esta frase" no
+    catálogo inteiro: intersecta as listas de postagem dos trigramas da
+    frase (menores primeiro) e confirma a substring só nos candidatos que
+    sobraram. ``defining`` devolve as descrições que definem uma sigla
+    entre parênteses — "(tsh)", "(psa)".
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+        postings = {}
+        acronyms = {}
+
+        for i in range(len(catalog)):
+            norm = catalog.norm_desc(i)
+
+            for gram in trigrams(norm):
+                postings.setdefault(gram, []).append(i)
+
+            for acr in ACRONYM.findall(norm):
+                acronyms.setdefault(acr, []).append(i)
+
+        self._postings = {g: np.array(rows, dtype=np.int32) for g, rows in postings.items()}
+        self._acronyms = {a: np.array(rows, dtype=np.int32) for a, rows in acronyms.items()}
+
+    def containing(self, phrase: str):
+        grams = trigrams(phrase)
+
+        if not grams:
+            return EMPTY_ROWS
+
+        lists = []
+        for gram in grams:
+            rows = self._postings.get(gram)
+            if rows is None:
+                return EMPTY_ROWS
+            lists.append(rows)
+
+        lists.sort(key=len)
+
+        rows = lists[0]
+        for other in lists[1:]:
+            if len(rows) <= 8:
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+            if not len(rows):
+                return EMPTY_ROWS
+
+        # trigramas não garantem a ordem — confirma a substring
+        return np.array(
+            [r for r in rows if phrase in self.catalog.norm_desc(r)],
+            dtype=np.int32,
+        )
+
+    def defining(self, acronym: str):
+        return self._acronyms.get(acronym, EMPTY_ROWS)
+
+    def distinct_codes(self, rows):
+        return {self.catalog.code(r) for r in rows}
@@ -1,17 +1,221 @@
-import json
 import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
 from datetime import datetime
 
-LOG_DIR = "/app/data/logs"
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+LOG_DIR = os.environ.get("LOG_DIR", os.path.join(DATA_DIR, "logs"))
 
-def save_debug_log(job_id: str, payload: dict):
-    os.makedirs(LOG_DIR, exist_ok=True)
+# segmentos JSON Lines comprimidos, rotacionados por tamanho
+LOG_SEGMENT_MAX_BYTES = int(os.environ.get("LOG_SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+# logs aguardando o writer; cheia, a task espera (nenhum log é descartado)
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 1000))
+
+INDEX_FILE = "index.sqlite3"
+
+log = logging.getLogger(__name__)
+
+
+def _connect(log_dir: str):
+    db = sqlite3.connect(os.path.join(log_dir, INDEX_FILE), timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS logs ("
+        " job_id TEXT PRIMARY KEY,"
+        " segment TEXT NOT NULL,"
+        " offset INTEGER NOT NULL,"
+        " length INTEGER NOT NULL,"
+        " line_offset INTEGER NOT NULL DEFAULT 0,"
+        " line_length INTEGER)"
+    )
+
+    # índice de antes do membro por lote: um membro gzip por log, que
+    # continua sendo lido inteiro (line_length NULL)
+    columns = {row[1] for row in db.execute("PRAGMA table_info(logs)")}
+    if "line_offset" not in columns:
+        with db:
+            db.execute("ALTER TABLE logs ADD COLUMN line_offset INTEGER NOT NULL DEFAULT 0")
+            db.execute("ALTER TABLE logs ADD COLUMN line_length INTEGER")
+
+    return db
+
+
+class LogSink:
+    """
+    Grava os logs de decisão fora do caminho crítico da task.
+
+    ``write`` só enfileira; uma thread por processo drena a fila e grava
+    os logs que estavam esperando como um único membro gzip no segmento
+    atual (``decisions-<pid>-<início>.jsonl.gz``) — logs pequenos
+    comprimem juntos, sem um header/trailer gzip por log. O índice SQLite
+    guarda job_id → (segmento, offset e tamanho do membro, offset e
+    tamanho da linha dentro do membro descomprimido). Ler um log é uma
+    consulta ao índice, um seek e a descompressão de um membro. O segmento
+    inteiro continua legível com ``zcat``.
+    """
+
+    def __init__(self, log_dir=LOG_DIR, segment_max_bytes=LOG_SEGMENT_MAX_BYTES,
+                 queue_size=LOG_QUEUE_SIZE):
+        self.log_dir = log_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    # ======================================================
+    # Produtor (task)
+    # ======================================================
+    def _ensure_writer(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            # depois de um fork (prefork) a thread do pai não existe
+            # aqui: cada processo tem fila, writer e segmento próprios
+            os.makedirs(self.log_dir, exist_ok=True)
+
+            self._queue = queue.Queue(self.queue_size)
+            threading.Thread(target=self._run, name="log-sink", daemon=True).start()
+            self._pid = pid
+
+    def write(self, job_id: str, payload: dict):
+        self._ensure_writer()
+        self._queue.put((job_id, payload))
+
+    def flush(self):
+        """Espera o writer gravar tudo o que já foi enfileirado."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    # ======================================================
+    # Writer (thread)
+    # ======================================================
+    def _run(self):
+        db = _connect(self.log_dir)
+        segment = None
+        out = None
+
+        while True:
+            batch = [self._queue.get()]
+
+            # drena o que já está na fila: um commit no índice por lote
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
 
+            try:
+                if out is None or out.tell() >= self.segment_max_bytes:
+                    if out is not None:
+                        out.close()
+                    segment = f"decisions-{os.getpid()}-{time.time_ns()}.jsonl.gz"
+                    out = open(os.path.join(self.log_dir, segment), "ab")
+
+                # o lote inteiro vira um membro gzip; cada log é uma linha
+                lines = []
+                positions = []
+                line_offset = 0
+
+                for job_id, payload in batch:
+                    line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+                    lines.append(line)
+                    positions.append((job_id, line_offset, len(line)))
+                    line_offset += len(line)
+
+                data = gzip.compress(b"".join(lines))
+                offset = out.tell()
+                out.write(data)
+
+                rows = [
+                    (job_id, segment, offset, len(data), line_offset, line_length)
+                    for job_id, line_offset, line_length in positions
+                ]
+
+                # dados no disco antes do índice apontar para eles
+                out.flush()
+
+                with db:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?)", rows
+                    )
+
+            except Exception:
+                log.exception("falha gravando %s logs de decisão", len(batch))
+
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    # ======================================================
+    # Leitura
+    # ======================================================
+    def read(self, job_id: str):
+        """Log do job (dict) ou None. Aceita também o JSON avulso antigo."""
+        index_path = os.path.join(self.log_dir, INDEX_FILE)
+
+        if os.path.exists(index_path):
+            # _connect: migra um índice antigo antes da consulta
+            db = _connect(self.log_dir)
+            try:
+                row = db.execute(
+                    "SELECT segment, offset, length, line_offset, line_length"
+                    " FROM logs WHERE job_id = ?",
+                    (job_id,),
+                ).fetchone()
+            finally:
+                db.close()
+
+            if row is not None:
+                segment, offset, length, line_offset, line_length = row
+                with open(os.path.join(self.log_dir, segment), "rb") as f:
+                    f.seek(offset)
+                    data = gzip.decompress(f.read(length))
+                if line_length is not None:
+                    data = data[line_offset:line_offset + line_length]
+                return json.loads(data)
+
+        # formato antigo: um JSON por job
+        legacy = os.path.join(self.log_dir, f"{job_id}.json")
+        if os.path.exists(legacy):
+            with open(legacy, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        return None
+
+
+_sink = LogSink()
+
+atexit.register(_sink.flush)
+
+
+def save_debug_log(job_id: str, payload: dict):
+    """
+    Enfileira o log do job e retorna na hora; a gravação é assíncrona.
+    Retorna a rota da API que devolve o log.
+    """
     payload["timestamp"] = datetime.utcnow().isoformat()
 
-    path = os.path.join(LOG_DIR, f"{job_id}.json")
+    _sink.write(job_id, payload)
+
+    return f"/ocr/log/{job_id}"
+
+
+def get_log(job_id: str):
+    return _sink.read(job_id)
 
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
 
-    return path
+def flush_logs():
+    _sink.flush()
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+
+from app.metrics import MATCH_CACHE_REQUESTS
+
+MATCH_CACHE_ENABLED = os.environ.get("MATCH_CACHE_ENABLED", "1") not in ("0", "false", "False")
+# entradas (linhas) no LRU de cada processo
+MATCH_CACHE_SIZE = int(os.environ.get("MATCH_CACHE_SIZE", 50000))
+MATCH_CACHE_REDIS_URL = os.environ.get("MATCH_CACHE_REDIS_URL")  # opcional
+MATCH_CACHE_TTL = int(os.environ.get("MATCH_CACHE_TTL", 7 * 24 * 3600))
+
+log = logging.getLogger(__name__)
+
+
+def _redis_key(tag: str, line: str):
+    return "match:" + tag + ":" + hashlib.sha1(line.encode("utf-8")).hexdigest()
+
+
+class MatchCache:
+    """
+    Cache linha → decisão do matcher.
+
+    Chave: texto exato da linha (o que vai ao modelo) + ``tag`` (versão do catálogo,
+    thresholds e regras). Um catálogo novo muda a tag e as entradas
+    antigas simplesmente deixam de ser encontradas (no Redis, expiram
+    pelo TTL). Dois níveis: LRU em memória do processo e, opcionalmente,
+    Redis compartilhado entre workers. Falhas no Redis viram miss.
+    """
+
+    def __init__(self, max_entries=MATCH_CACHE_SIZE, redis_url=MATCH_CACHE_REDIS_URL,
+                 ttl=MATCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+
+    # ======================================================
+    # LRU local
+    # ======================================================
+    def _local_get(self, key):
+        with self._lock:
+            decision = self._lru.get(key)
+            if decision is not None:
+                self._lru.move_to_end(key)
+            return decision
+
+    def _local_set(self, key, decision):
+        with self._lock:
+            self._lru[key] = decision
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    # ======================================================
+    # API — em lote: um round-trip ao Redis por documento
+    # ======================================================
+    def get_many(self, tag: str, lines):
+        """{linha: decisão} das linhas encontradas (sem o campo "text")."""
+        lines = list(dict.fromkeys(lines))
+        found = {}
+        remote = []
+
+        for line in lines:
+            decision = self._local_get((tag, line))
+            if decision is not None:
+                found[line] = decision
+                MATCH_CACHE_REQUESTS.labels("local_hit").inc()
+            else:
+                remote.append(line)
+
+        if remote and self.redis is not None:
+            try:
+                values = self.redis.mget([_redis_key(tag, line) for line in remote])
+            except redis.RedisError as e:
+                log.warning("match cache (redis) indisponível: %s", e)
+                values = [None] * len(remote)
+
+            for line, raw in zip(remote, values):
+                if raw is None:
+                    continue
+                decision = json.loads(raw)
+                found[line] = decision
+                self._local_set((tag, line), decision)
+                MATCH_CACHE_REQUESTS.labels("redis_hit").inc()
+
+        MATCH_CACHE_REQUESTS.labels("miss").inc(len(lines) - len(found))
+
+        return found
+
+    def set_many(self, tag: str, decisions):
+        """``decisions``: {linha: decisão} (sem o campo "text")."""
+        for line, decision in decisions.items():
+            self._local_set((tag, line), decision)
+
+        if self.redis is None or not decisions:
+            return
+
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for line, decision in decisions.items():
+                pipe.set(
+                    _redis_key(tag, line),
+                    json.dumps(decision, ensure_ascii=False).encode("utf-8"),
+                    ex=self.ttl,
+                )
+            pipe.execute()
+        except redis.RedisError as e:
+            log.warning("match cache (redis) indisponível: %s", e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_match_cache():
+    """Cache do processo, ou None se desabilitado via MATCH_CACHE_ENABLED=0."""
+    global _cache
+    if _cache is None and MATCH_CACHE_ENABLED:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MatchCache()
+    return _cache
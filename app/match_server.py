@@ -0,0 +1,213 @@
+"""
+Servidor de matching síncrono: POST /match com texto já extraído (OCR de
+outro sistema, pedidos digitados), sem upload, Celery nem OCR.
+
+Roda em processo próprio, com o matcher carregado uma vez:
+
+    uvicorn app.match_server:app --host 0.0.0.0 --port 8001
+
+Requisições que chegam com poucos milissegundos de diferença viram um
+único ``match_many`` (um encode + uma busca para todas as linhas).
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from app.matcher import get_matcher
+from app.metrics import observe, render_metrics, MATCH_SERVER_BATCH
+
+# textos por match_many; um lote cheio sai sem esperar
+MATCH_MAX_BATCH = int(os.environ.get("MATCH_MAX_BATCH", 64))
+# espera máxima da primeira requisição do lote por outras
+MATCH_MAX_WAIT_MS = float(os.environ.get("MATCH_MAX_WAIT_MS", 5))
+
+log = logging.getLogger(__name__)
+
+app = FastAPI()
+
+
+class MatchRequest(BaseModel):
+    text: Optional[str] = None
+    texts: Optional[List[str]] = None
+    trace: bool = False
+
+
+class MicroBatcher:
+    """
+    Fila de requisições → lotes de até ``max_batch`` textos.
+
+    O lote fecha quando enche ou quando a requisição mais antiga já
+    esperou ``max_wait`` segundos. O match roda numa única thread fora do
+    event loop; enquanto um lote roda, o próximo vai se acumulando.
+    """
+
+    def __init__(self, matcher, max_batch=MATCH_MAX_BATCH, max_wait=MATCH_MAX_WAIT_MS / 1000):
+        self.matcher = matcher
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="match")
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, texts):
+        """[MatchResult] dos textos, na ordem."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future, time.perf_counter()))
+        return await future
+
+    async def close(self):
+        self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    async def _collect(self):
+        first = await self._queue.get()
+        batch, size = [first], len(first[0])
+        deadline = first[2] + self.max_wait
+
+        while size < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch.append(item)
+            size += len(item[0])
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._collect()
+            texts = [text for item in batch for text in item[0]]
+
+            start = time.perf_counter()
+            for _, _, queued in batch:
+                observe("match_server_wait", start - queued)
+            MATCH_SERVER_BATCH.observe(len(texts))
+
+            try:
+                results = await loop.run_in_executor(self._executor, self.matcher.match_many, texts)
+            except Exception as e:
+                if len(batch) == 1:
+                    log.exception("falha no match de %s textos", len(texts))
+                    self._finish(batch[0][1], error=e)
+                else:
+                    # um texto problemático não derruba as outras requisições
+                    log.warning("falha no lote de %s textos (%s); repetindo por requisição",
+                                len(texts), e)
+                    await self._run_each(batch)
+                continue
+
+            observe("match_server_batch", time.perf_counter() - start)
+
+            i = 0
+            for item_texts, future, _ in batch:
+                self._finish(future, results[i:i + len(item_texts)])
+                i += len(item_texts)
+
+    async def _run_each(self, batch):
+        loop = asyncio.get_running_loop()
+
+        for item_texts, future, _ in batch:
+            if future.done():
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.matcher.match_many, item_texts
+                )
+            except Exception as e:
+                log.exception("falha no match de %s textos", len(item_texts))
+                self._finish(future, error=e)
+            else:
+                self._finish(future, results)
+
+    @staticmethod
+    def _finish(future, results=None, error=None):
+        if future.done():  # cliente pode ter desistido
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(results)
+
+
+batcher = None
+
+
+@app.on_event("startup")
+async def load_matcher():
+    global batcher
+
+    loop = asyncio.get_running_loop()
+
+    def warm_up():
+        matcher = get_matcher()
+        matcher.match("aquecimento")
+        return matcher
+
+    matcher = await loop.run_in_executor(None, warm_up)
+    batcher = MicroBatcher(matcher)
+    log.info("match server pronto (lote %s, espera %s ms)", MATCH_MAX_BATCH, MATCH_MAX_WAIT_MS)
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    if batcher is not None:
+        await batcher.close()
+
+
+def result_response(result, trace: bool):
+    body = {"codes": result.codes, "catalog_version": result.catalog_version}
+    if trace:
+        body["trace"] = result.trace
+    return body
+
+
+@app.post("/match")
+async def match(request: MatchRequest):
+    """
+    ``{"text": "..."}`` → ``{"codes", "catalog_version"}``;
+    ``{"texts": [...]}`` → ``{"results": [...]}`` na mesma ordem.
+    ``"trace": true`` inclui as decisões linha a linha.
+    """
+    if (request.text is None) == (request.texts is None):
+        raise HTTPException(400, "Informe text ou texts")
+
+    texts = [request.text] if request.text is not None else request.texts
+    if not texts:
+        return {"results": []}
+
+    results = await batcher.submit(texts)
+
+    if request.text is not None:
+        return result_response(results[0], request.trace)
+    return {"results": [result_response(r, request.trace) for r in results]}
+
+
+@app.get("/health")
+async def health():
+    if batcher is None:
+        raise HTTPException(503, "Carregando o matcher")
+    return {"status": "ok", "catalog_version": batcher.matcher.catalog_version}
+
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
@@ -1,83 +1,452 @@
 import os
-import csv
 import re
+import time
+import logging
+import threading
+from typing import NamedTuple
 
-from sentence_transformers import SentenceTransformer
-import faiss
+from app.catalog import normalize_text
+from app.encoder import get_encoder
+from app.embedding_index import (
+    INDEX_DIR, INDEX_TYPE, MANIFEST_FILE, load_or_build_index, catalog_version,
+)
+from app.lexical import LexicalIndex, PhraseIndex, EMPTY_ROWS, FUZZY_THRESHOLD, FUZZY_MIN_LEN
+from app.match_cache import get_match_cache
+from app.metrics import timed, MATCH_LINES, MODEL_LOAD_SECONDS
 
 
 PROCEDURES_CSV = os.environ.get("PROCEDURES_CSV", "/app/data/procedimentos.csv")
 THRESHOLD = float(os.environ.get("MATCHER_THRESHOLD", 0.88))
+BATCH_SIZE = int(os.environ.get("MATCHER_BATCH_SIZE", 64))
+
+# a cada N segundos verifica se o CSV ou o artefato do índice mudaram
+# e troca o catálogo em segundo plano; 0 = sem hot reload
+RELOAD_INTERVAL = float(os.environ.get("MATCHER_RELOAD_INTERVAL", 60))
 
 CODE_REGEX = re.compile(r"\b\d{6,10}\b")
 
+# incremente ao mudar as regras de decisão: invalida o cache de linhas
+RULES_VERSION = 3
+
+log = logging.getLogger(__name__)
+
+# palavras que, no início da linha, indicam continuação da linha anterior
+CONTINUATION_WORDS = {
+    "quantitativo",
+    "qualitativo",
+    "total",
+    "livre",
+    "digital",
+    "ultra-sensivel",
+    "alta sensibilidade",
+    "basal",
+    "seriado",
+}
+
+# stopwords genéricas (não devem disparar contains). Palavras para ignorar
+STOPWORDS = {
+    "outros",
+    "diversos",
+    "exames",
+    "resultado",
+    "resultados",
+    "observacao",
+    "observacoes",
+    "observação",
+    "observações",
+}
+
+# siglas válidas que podem ser palavra única
+KNOWN_SINGLE_EXAMS = {"psa", "pcr", "tsh", "t4", "t3", "vitd"}
+
+
+def has_letters(s: str):
+    return any(ch.isalpha() for ch in s)
+
+
+class CatalogState:
+    """
+    Uma versão do catálogo: tabela, embeddings, índice e índices léxicos.
+    Nunca é alterada — o hot reload monta outra e troca a referência.
+    """
+
+    def __init__(self, catalog, emb, index, manifest):
+        self.catalog = catalog
+        self.emb = emb
+        self.index = index
+        self.manifest = manifest
+
+        self.lexical = LexicalIndex(catalog)
+        self.phrases = PhraseIndex(catalog)
+
+        self.version = catalog_version(manifest, INDEX_TYPE)
+
+        # cache linha → decisão: a tag muda com o catálogo, os thresholds
+        # e as regras, então um catálogo novo nunca lê decisões antigas
+        self.cache_tag = f"{self.version}:{THRESHOLD}:{FUZZY_THRESHOLD}:{FUZZY_MIN_LEN}:r{RULES_VERSION}"
+
+
+class MatchResult(NamedTuple):
+    """Resultado de um texto. Tupla: ``codes, trace, version = result``."""
+
+    codes: list
+    trace: list
+    catalog_version: str
+
+
+class _SearchRequest:
+    __slots__ = ("state", "lines", "done", "finished", "scores", "idx", "error")
+
+    def __init__(self, state, lines):
+        self.state = state
+        self.lines = lines
+        self.done = threading.Event()
+        self.finished = False
+        self.scores = self.idx = self.error = None
+
+
+class SearchCoalescer:
+    """
+    Junta as buscas de chamadas concorrentes (threads do mesmo processo)
+    num único encode + search.
+
+    Sem thread extra: quem chega com o modelo livre vira líder e roda o
+    lote com tudo o que está pendente; quem chega durante o lote espera e,
+    no fim, o primeiro da fila assume a liderança com os que se acumularam
+    (group commit). Uma chamada sozinha não espera nada.
+    """
+
+    def __init__(self, search):
+        self._search = search
+        self._lock = threading.Lock()
+        self._pending = []
+        self._busy = False
+
+    def __call__(self, state, lines):
+        request = _SearchRequest(state, lines)
+
+        with self._lock:
+            self._pending.append(request)
+            leader = not self._busy
+            self._busy = True
+
+        if not leader:
+            request.done.wait()
+
+        # acordado sem resultado: virou o líder do próximo lote
+        if not request.finished:
+            self._lead()
+
+        if request.error is not None:
+            raise request.error
+        return request.scores, request.idx
+
+    def _lead(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+
+        # versões diferentes do catálogo (reload no meio) não se misturam
+        by_state = {}
+        for request in batch:
+            by_state.setdefault(id(request.state), []).append(request)
+
+        for requests in by_state.values():
+            self._run(requests)
+
+        with self._lock:
+            if self._pending:
+                self._pending[0].done.set()
+            else:
+                self._busy = False
+
+    def _search_together(self, requests):
+        position = {}
+        for request in requests:
+            for line in request.lines:
+                position.setdefault(line, len(position))
+
+        scores, idx = self._search(requests[0].state, list(position))
+
+        for request in requests:
+            rows = [position[line] for line in request.lines]
+            request.scores, request.idx = scores[rows], idx[rows]
+
+    def _run(self, requests):
+        try:
+            self._search_together(requests)
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].error = e
+            else:
+                # uma linha problemática não derruba as outras chamadas:
+                # cada uma tenta de novo sozinha e só a que falha recebe o erro
+                log.warning("busca em lote falhou (%s); repetindo por chamada", e)
+                for request in requests:
+                    try:
+                        self._search_together([request])
+                    except Exception as e:
+                        request.error = e
+
+        for request in requests:
+            request.finished = True
+            request.done.set()
+
 
 class ProcedureMatcher:
+    """
+    Sem estado por chamada: ``match``/``match_many`` podem ser usados ao
+    mesmo tempo por várias threads. Modelo, índice e catálogo são só
+    lidos; chamadas concorrentes dividem os lotes de embeddings.
+    """
 
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, batch_size: int = BATCH_SIZE):
         self.csv_path = csv_path
-        self.debug_trace = []
+        self.batch_size = batch_size
 
-        self._index_by_code = {}
-        self._descs = []
+        # torch, onnx ou onnx-int8 (EMBEDDING_BACKEND)
+        start = time.perf_counter()
+        self.encoder = get_encoder()
+        MODEL_LOAD_SECONDS.labels("embedding_model").observe(time.perf_counter() - start)
 
-        self._load_csv()
+        self.cache = get_match_cache()
+        self._coalesced_search = SearchCoalescer(self._search)
 
-        self.model = SentenceTransformer("sentence-transformers/all-mpnet-base-v2")
+        self._reload_lock = threading.Lock()
+        self._watcher_lock = threading.Lock()
+        self._watcher_pid = None
 
-        self.index, self.emb_matrix = self._build_index()
+        # artefato único (o mesmo de scripts/build_procedure_index.py):
+        # carregado do disco, reconstruído incrementalmente se o CSV mudou
+        self.state = None
+        self.reload()
 
-    # ======================================================
-    # CSV robusto — encoding + delimitador detectado
-    # ======================================================
-    def _load_csv(self):
-        encodings = ["utf-8-sig", "utf-8", "latin-1"]
-        last_err = None
+    # atalhos para a versão atual (scripts de debug, benchmark)
+    @property
+    def catalog(self):
+        return self.state.catalog
 
-        for enc in encodings:
-            try:
-                with open(self.csv_path, encoding=enc, newline="") as f:
-                    sample = f.read(2048)
-                    f.seek(0)
+    @property
+    def index(self):
+        return self.state.index
 
-                    delimiter = ";" if sample.count(";") > sample.count(",") else ","
+    @property
+    def lexical(self):
+        return self.state.lexical
 
-                    reader = csv.DictReader(f, delimiter=delimiter)
+    @property
+    def catalog_version(self):
+        return self.state.version
 
-                    for row in reader:
-                        code = row["CODIGO"].strip()
-                        desc = row["DESCRICAO"].strip()
+    # ======================================================
+    # Hot reload do catálogo
+    # ======================================================
+    def _signature(self):
+        """mtime/tamanho do CSV e do manifest do artefato."""
+        sig = []
+        for path in (self.csv_path, os.path.join(INDEX_DIR, MANIFEST_FILE)):
+            try:
+                st = os.stat(path)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def reload(self):
+        """
+        Carrega o catálogo atual — reconstruindo o índice se o CSV mudou,
+        com os embeddings das linhas inalteradas reaproveitados — e troca
+        o estado de uma vez. Retorna True se a versão mudou.
+        """
+        with self._reload_lock:
+            start = time.perf_counter()
+
+            catalog, emb, index, manifest = load_or_build_index(
+                self.csv_path,
+                self.encoder,
+                index_dir=INDEX_DIR,
+                index_type=INDEX_TYPE,
+                batch_size=self.batch_size,
+            )
+            self._loaded_signature = self._signature()
+
+            if self.state is not None and catalog_version(manifest, INDEX_TYPE) == self.state.version:
+                return False
+
+            state = CatalogState(catalog, emb, index, manifest)
+            MODEL_LOAD_SECONDS.labels("catalog_index").observe(time.perf_counter() - start)
+
+            if self.state is not None:
+                log.info("catálogo %s → %s (%s procedimentos)",
+                         self.state.version, state.version, len(catalog))
+
+            # troca atômica: quem já pegou o estado antigo termina com ele
+            self.state = state
+            return True
+
+    def _ensure_watcher(self):
+        # uma thread por processo; no prefork, a do pai não existe no filho
+        pid = os.getpid()
+        if not RELOAD_INTERVAL or self._watcher_pid == pid:
+            return
+
+        with self._watcher_lock:
+            if self._watcher_pid == pid:
+                return
+            threading.Thread(target=self._watch, name="catalog-reload", daemon=True).start()
+            self._watcher_pid = pid
 
-                        self._index_by_code[code] = desc
-                        self._descs.append((code, desc))
+    def _watch(self):
+        while True:
+            time.sleep(RELOAD_INTERVAL)
 
-                return
+            if self._signature() == self._loaded_signature:
+                continue
+
+            try:
+                self.reload()
+            except Exception:
+                log.exception("falha recarregando o catálogo; mantendo %s", self.state.version)
 
-            except Exception as e:
-                last_err = e
+    # ======================================================
+    # Busca em lote — um único encode + um único search
+    # ======================================================
+    def _search(self, state, lines):
+        with timed("embed_encode"):
+            query_emb = self.encoder.encode(
+                lines,
+                batch_size=self.batch_size,
+                normalize=True,
+            )
 
-        raise RuntimeError(
-            f"Falha ao abrir CSV {self.csv_path}. Último erro: {last_err}"
-        )
+        with timed("index_search"):
+            return state.index.search(query_emb, 1)
 
     # ======================================================
-    def _build_index(self):
-        descriptions = [d[1] for d in self._descs]
+    # Regra contains — quais descrições contêm o termo
+    # ======================================================
+    def _contains_rows(self, state, norm_line: str):
+        """
+        (linhas cujas descrições contêm o termo, True se é uma sigla
+        definida por uma única descrição — aceita sem o modelo).
+        """
+        tokens = norm_line.split()
+        is_single_word = len(tokens) == 1
+
+        if not (
+            norm_line
+            and len(norm_line.replace(" ", "")) >= 3
+            and has_letters(norm_line)
+            and norm_line not in STOPWORDS
+            and (
+                not is_single_word or norm_line in KNOWN_SINGLE_EXAMS
+            )
+        ):
+            return EMPTY_ROWS, False
+
+        # sigla: prioriza a descrição que a define — "Tiroxina (T4)"
+        if is_single_word:
+            rows = state.phrases.defining(norm_line)
+            if len(state.phrases.distinct_codes(rows)) == 1:
+                return rows, True
+
+        return state.phrases.containing(norm_line), False
 
-        emb = self.model.encode(
-            descriptions,
-            convert_to_numpy=True
-        ).astype("float32")
+    # ======================================================
+    # Atalho léxico — resolve a linha sem chamar o modelo.
+    # Retorna (decisão ou None, linhas que contêm o termo)
+    # ======================================================
+    def _lexical_decision(self, state, line: str):
+        norm = normalize_text(line)
+
+        row = state.lexical.exact(norm)
+        if row is not None:
+            code, desc = state.catalog[row]
+            return {
+                "stage": "lexical_exact",
+                "text": line,
+                "candidate": {"code": code, "desc": desc},
+                "score": 1.0,
+                "accepted": True,
+                "explanation": "Aceito porque a linha é idêntica à descrição (sem acentos/caixa)"
+            }, EMPTY_ROWS
+
+        hit = state.lexical.fuzzy(norm)
+        if hit is not None:
+            row, score = hit
+            code, desc = state.catalog[row]
+            return {
+                "stage": "lexical_fuzzy",
+                "text": line,
+                "candidate": {"code": code, "desc": desc},
+                "score": score,
+                "accepted": True,
+                "explanation": "Aceito porque a linha é quase idêntica à descrição (erro de OCR)"
+            }, EMPTY_ROWS
+
+        # ----------------------------------------------
+        # 🔥 REGRA CONTAINS — RESTRITA (índice invertido)
+        # ----------------------------------------------
+        containers, defined = self._contains_rows(state, norm)
+
+        # só a sigla definida dispensa o modelo: "Colesterol LDL" está
+        # contido só em "Colesterol LDL peroxidada", mas o pedido é o
+        # "Colesterol (LDL)" — termos com várias palavras vão ao modelo
+        if defined:
+            code, desc = state.catalog[int(containers[0])]
+            return {
+                "stage": "rule_contains",
+                "text": line,
+                "candidate": {"code": code, "desc": desc},
+                "score": None,
+                "accepted": True,
+                "explanation": "Aceito porque a sigla é definida em uma única descrição do catálogo"
+            }, containers
 
-        index = faiss.IndexFlatIP(emb.shape[1])
-        faiss.normalize_L2(emb)
-        index.add(emb)
+        return None, containers
 
-        return index, emb
+    # ======================================================
+    # Decisão por embeddings (contains restrito + threshold)
+    # ======================================================
+    def _embedding_decision(self, state, line: str, score: float, row: int, containers):
+        code, desc = state.catalog[row]
+
+        # ----------------------------------------------
+        # Termo presente em descrições do catálogo: aceita
+        # se o top-1 do modelo é uma delas
+        # ----------------------------------------------
+        if row in containers:
+            return {
+                "stage": "rule_contains",
+                "text": line,
+                "candidate": {"code": code, "desc": desc},
+                "score": score,
+                "accepted": True,
+                "explanation": "Aceito porque o termo significativo aparece dentro da descrição"
+            }
+
+        # ----------------------------------------------
+        # Threshold normal
+        # ----------------------------------------------
+        accepted = score >= THRESHOLD
+
+        return {
+            "stage": "embeddings",
+            "text": line,
+            "candidate": {"code": code, "desc": desc},
+            "score": score,
+            "accepted": accepted,
+            "explanation": (
+                "Aceito por similaridade"
+                if accepted else
+                "Rejeitado — similaridade insuficiente"
+            )
+        }
 
     # ======================================================
-    def match_codes_from_text(self, text: str):
-        self.debug_trace = []
+    # Etapas sem modelo (regex, normalização, atalho léxico)
+    # ======================================================
+    def _analyze(self, state, text: str):
+        trace = []
         found_codes = set()
 
         # --------------------------------------------------
@@ -86,156 +455,172 @@ class ProcedureMatcher:
         numeric = CODE_REGEX.findall(text)
 
         if numeric:
-            self.debug_trace.append({
+            trace.append({
                 "stage": "regex",
                 "found": numeric,
                 "explanation": "Códigos numéricos encontrados diretamente no texto"
             })
 
             for c in numeric:
-                if c in self._index_by_code:
+                if state.catalog.has_code(c):
                     found_codes.add(c)
 
         # --------------------------------------------------
         # 2) Normalização de linhas — corrige quebras do OCR
         # --------------------------------------------------
-        raw_lines = [l.strip() for l in text.splitlines() if l.strip()]
-        lines = []
-
-        CONTINUATION_WORDS = {
-            "quantitativo",
-            "qualitativo",
-            "total",
-            "livre",
-            "digital",
-            "ultra-sensivel",
-            "alta sensibilidade",
-            "basal",
-            "seriado",
-        }
-
-        for line in raw_lines:
-            lower = line.lower()
-
-            if (
-                lines
-                and (
-                    line.startswith(("(", "-", "–"))
-                    or line[0].islower()
-                    or any(lower.startswith(w) for w in CONTINUATION_WORDS)
-                )
-            ):
-                lines[-1] = f"{lines[-1]} {line}".strip()
-            else:
-                lines.append(line)
-
-        self.debug_trace.append({
+        with timed("line_normalization"):
+            raw_lines = [l.strip() for l in text.splitlines() if l.strip()]
+            lines = []
+
+            for line in raw_lines:
+                lower = line.lower()
+
+                if (
+                    lines
+                    and (
+                        line.startswith(("(", "-", "–"))
+                        or line[0].islower()
+                        or any(lower.startswith(w) for w in CONTINUATION_WORDS)
+                    )
+                ):
+                    lines[-1] = f"{lines[-1]} {line}".strip()
+                else:
+                    lines.append(line)
+
+        trace.append({
             "stage": "line_normalization",
             "result": lines,
             "explanation": "Linhas unidas quando OCR quebrou indevidamente"
         })
 
-        # helper
-        def has_letters(s: str):
-            return any(ch.isalpha() for ch in s)
-
-        # stopwords genéricas (não devem disparar contains). Palavras para ignorar
-        STOPWORDS = {
-            "outros",
-            "diversos",
-            "exames",
-            "resultado",
-            "resultados",
-            "observacoes",
-            "observação",
-            "observações",
+        # --------------------------------------------------
+        # 3) Atalho léxico — linhas resolvidas sem o modelo
+        # --------------------------------------------------
+        candidates = [line for line in lines if not CODE_REGEX.search(line)]
+
+        # linhas já decididas (neste ou em outro worker) nem passam pelo
+        # léxico. A chave é a linha exata que iria ao modelo: variantes com
+        # acento/caixa diferentes podem ter embeddings diferentes
+        cached = {}
+        if self.cache is not None and candidates:
+            with timed("match_cache"):
+                cached = self.cache.get_many(state.cache_tag, candidates)
+
+        decisions, containers = [], []
+        with timed("lexical"):
+            for line in candidates:
+                hit = cached.get(line)
+                if hit is not None:
+                    decisions.append({"stage": hit["stage"], "text": line, **hit, "cached": True})
+                    containers.append(EMPTY_ROWS)
+                    MATCH_LINES.labels("cached", hit["stage"]).inc()
+                    continue
+
+                decision, rows = self._lexical_decision(state, line)
+                decisions.append(decision)
+                containers.append(rows)
+
+                if decision is not None:
+                    MATCH_LINES.labels("short_circuit", decision["stage"]).inc()
+
+        return {
+            "found_codes": found_codes,
+            "trace": trace,
+            "candidates": candidates,
+            "decisions": decisions,
+            "containers": containers,
         }
 
-        # siglas válidas que podem ser palavra única
-        KNOWN_SINGLE_EXAMS = {"psa", "pcr", "tsh", "t4", "t3", "vitd"}
+    # ======================================================
+    # Vários textos de uma vez: as linhas ambíguas de todos
+    # os documentos dividem os mesmos lotes de embeddings.
+    # Retorna [MatchResult] na ordem dos textos.
+    # ======================================================
+    def match_many(self, texts):
+        self._ensure_watcher()
 
-        # --------------------------------------------------
-        # 3) Embeddings linha a linha
-        # --------------------------------------------------
-        for line in lines:
+        # o lote inteiro usa a mesma versão, mesmo se houver reload no meio
+        state = self.state
 
-            if CODE_REGEX.search(line):
-                continue
+        docs = [self._analyze(state, text) for text in texts]
 
-            query_emb = self.model.encode(
-                [line],
-                convert_to_numpy=True
-            ).astype("float32")
+        # --------------------------------------------------
+        # 4) Embeddings em lote — só as linhas ambíguas são
+        #    codificadas e buscadas, de uma só vez
+        # --------------------------------------------------
+        pending = [
+            (doc, i)
+            for doc in docs
+            for i, decision in enumerate(doc["decisions"])
+            if decision is None
+        ]
+
+        if pending:
+            # a mesma linha em vários documentos é codificada uma vez só
+            unique = list(dict.fromkeys(doc["candidates"][i] for doc, i in pending))
+
+            # tempo desta chamada, incluindo a espera pelo lote compartilhado
+            with timed("embed_batch"):
+                all_scores, all_idx = self._coalesced_search(state, unique)
+            top = {
+                line: (float(row_scores[0]), int(row_idx[0]))
+                for line, row_scores, row_idx in zip(unique, all_scores, all_idx)
+            }
+
+            for doc, i in pending:
+                score, row = top[doc["candidates"][i]]
+                decision = self._embedding_decision(
+                    state, doc["candidates"][i], score, row, doc["containers"][i],
+                )
+                doc["decisions"][i] = decision
 
-            faiss.normalize_L2(query_emb)
+                MATCH_LINES.labels("embedded", decision["stage"]).inc()
 
-            scores, idx = self.index.search(query_emb, 1)
-            score = float(scores[0][0])
+        if self.cache is not None:
+            new = {
+                doc["candidates"][i]: {k: v for k, v in decision.items() if k != "text"}
+                for doc in docs
+                for i, decision in enumerate(doc["decisions"])
+                if not decision.get("cached")
+            }
+            if new:
+                self.cache.set_many(state.cache_tag, new)
 
-            code, desc = self._descs[idx[0][0]]
+        results = []
 
-            norm_line = line.lower().strip()
-            norm_desc = desc.lower().strip()
+        for doc in docs:
+            found_codes = doc["found_codes"]
+            trace = doc["trace"]
 
-            tokens = norm_line.split()
-            is_single_word = len(tokens) == 1
+            for decision in doc["decisions"]:
+                trace.append(decision)
 
-            # ----------------------------------------------
-            # 🔥 REGRA CONTAINS — RESTRITA
-            # ----------------------------------------------
-            if (
-                norm_line
-                and len(norm_line.replace(" ", "")) >= 3
-                and has_letters(norm_line)
-                and norm_line not in STOPWORDS
-                and (
-                    not is_single_word or norm_line in KNOWN_SINGLE_EXAMS
-                )
-                and norm_line in norm_desc
-            ):
-                self.debug_trace.append({
-                    "stage": "rule_contains",
-                    "text": line,
-                    "candidate": {"code": code, "desc": desc},
-                    "score": score,
-                    "accepted": True,
-                    "explanation": "Aceito porque o termo significativo aparece dentro da descrição"
-                })
-                found_codes.add(code)
-                continue
+                if decision["accepted"]:
+                    found_codes.add(decision["candidate"]["code"])
 
-            # ----------------------------------------------
-            # Threshold normal
-            # ----------------------------------------------
-            accepted = score >= THRESHOLD
+            results.append(MatchResult(sorted(found_codes), trace, state.version))
 
-            self.debug_trace.append({
-                "stage": "embeddings",
-                "text": line,
-                "candidate": {"code": code, "desc": desc},
-                "score": score,
-                "accepted": accepted,
-                "explanation": (
-                    "Aceito por similaridade"
-                    if accepted else
-                    "Rejeitado — similaridade insuficiente"
-                )
-            })
+        return results
 
-            if accepted:
-                found_codes.add(code)
+    def match(self, text: str):
+        """MatchResult (códigos + trace + versão do catálogo) de um texto."""
+        return self.match_many([text])[0]
 
-        return sorted(found_codes)
+    def match_codes_from_text(self, text: str):
+        return self.match(text).codes
 
 
 # =========================================================
 # Singleton
 # =========================================================
 _matcher_instance = None
+_matcher_lock = threading.Lock()
 
 
 def get_matcher():
     global _matcher_instance
     if _matcher_instance is None:
-        _matcher_instance = ProcedureMatcher(PROCEDURES_CSV)
+        with _matcher_lock:
+            if _matcher_instance is None:
+                _matcher_instance = ProcedureMatcher(PROCEDURES_CSV)
     return _matcher_instance
@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import (
+    Counter,
+    Histogram,
+    CollectorRegistry,
+    generate_latest,
+    start_http_server,
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+)
+
+# porta do servidor de métricas do worker (0 = desligado)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# prefork: cada filho grava as métricas em arquivos mmap neste diretório
+# e o servidor do pai agrega todos (modo multiprocess do prometheus_client)
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+if PROMETHEUS_MULTIPROC_DIR:
+    # precisa existir antes da criação das métricas abaixo
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# OCR de uma página leva segundos; encode/search, milissegundos
+STAGE_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+log = logging.getLogger(__name__)
+
+# =========================================================
+# Métricas
+# =========================================================
+STAGE_SECONDS = Histogram(
+    "ocr_stage_seconds",
+    "Duração de cada etapa do pipeline",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+PAGES_PER_JOB = Histogram(
+    "ocr_pages_per_job",
+    "Páginas por documento",
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+PAGES = Counter(
+    "ocr_pages_total",
+    "Páginas processadas, por origem do texto",
+    ["source"],  # ocr | text_layer | cached
+)
+
+MATCH_LINES = Counter(
+    "matcher_lines_total",
+    "Linhas decididas pelo matcher",
+    ["path", "stage"],  # path: cached | short_circuit (sem modelo) | embedded
+)
+
+CACHE_REQUESTS = Counter(
+    "ocr_cache_requests_total",
+    "Consultas ao cache de OCR",
+    ["result"],  # disk_hit | redis_hit | miss
+)
+
+MATCH_CACHE_REQUESTS = Counter(
+    "matcher_cache_requests_total",
+    "Consultas ao cache linha → decisão do matcher",
+    ["result"],  # local_hit | redis_hit | miss
+)
+
+MATCH_SERVER_BATCH = Histogram(
+    "match_server_batch_size",
+    "Textos por lote do match server (micro-batching)",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+MODEL_LOAD_SECONDS = Histogram(
+    "model_load_seconds",
+    "Tempo de carga dos modelos",
+    ["model"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+JOBS = Counter(
+    "ocr_jobs_total",
+    "Documentos processados",
+    ["task", "status"],  # status: ok | error
+)
+
+
+# =========================================================
+# Tempos por job — somados por etapa enquanto o job roda
+# =========================================================
+_job_timings = contextvars.ContextVar("job_timings", default=None)
+
+
+@contextmanager
+def job_timings():
+    """Coleta os tempos de ``timed`` deste contexto num dict etapa → s."""
+    timings = {}
+    token = _job_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _job_timings.reset(token)
+
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+    timings = _job_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+# =========================================================
+# Exposição (formato texto do Prometheus)
+# =========================================================
+def _registry():
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_metrics():
+    """(corpo, content-type) para o endpoint /metrics da API."""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def clear_multiprocess_dir():
+    """
+    Remove arquivos de execuções anteriores (distorceriam os contadores).
+    Os do processo atual ficam: já estão abertos desde o import.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+
+    own = f"_{os.getpid()}.db"
+
+    for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+        if name.endswith(".db") and not name.endswith(own):
+            try:
+                os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, name))
+            except OSError:
+                pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Servidor HTTP de métricas do worker; no prefork, roda no pai."""
+    if not port:
+        return
+
+    start_http_server(port, registry=_registry())
+    log.info("métricas em :%s/metrics", port)
+
+
+def mark_process_dead(pid: int):
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import logging
+
+import redis
+
+from app.metrics import CACHE_REQUESTS
+
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+
+OCR_CACHE_ENABLED = os.environ.get("OCR_CACHE_ENABLED", "1") not in ("0", "false", "False")
+OCR_CACHE_DIR = os.environ.get("OCR_CACHE_DIR", os.path.join(DATA_DIR, "ocr_cache"))
+OCR_CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+OCR_CACHE_REDIS_URL = os.environ.get("OCR_CACHE_REDIS_URL")  # opcional
+OCR_CACHE_TTL = int(os.environ.get("OCR_CACHE_TTL", 30 * 24 * 3600))
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(file_bytes: bytes, settings: dict):
+    """Hash do conteúdo + configurações do OCR (idiomas, DPI...)."""
+    h = hashlib.sha256(file_bytes)
+    h.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+class OcrCache:
+    """
+    Cache de resultados de OCR endereçado por conteúdo.
+
+    Dois níveis: disco local (um arquivo por entrada, LRU por mtime e
+    limitado em bytes) e, opcionalmente, Redis compartilhado entre hosts.
+    Falhas no cache nunca derrubam o OCR — viram apenas um miss.
+    """
+
+    def __init__(self, cache_dir=OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES,
+                 redis_url=OCR_CACHE_REDIS_URL, ttl=OCR_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = self._scan_size()
+
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+
+    # ======================================================
+    # Disco
+    # ======================================================
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".txt"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _disk_get(self, key: str):
+        path = self._path(key)
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return None
+
+        # mtime é o relógio do LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return text
+
+    def _disk_set(self, key: str, text: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = text.encode("utf-8")
+        tmp = f"{path}.{os.getpid()}.tmp"
+
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        self._size += len(data)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # recalcula do disco: outros processos também escrevem aqui
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+        self._size = total
+
+    # ======================================================
+    # API
+    # ======================================================
+    def get(self, key: str):
+        text, result = self._get(key)
+        CACHE_REQUESTS.labels(result).inc()
+        return text
+
+    def _get(self, key: str):
+        """(texto ou None, "disk_hit" | "redis_hit" | "miss")"""
+        text = self._disk_get(key)
+        if text is not None:
+            return text, "disk_hit"
+
+        if self.redis is None:
+            return None, "miss"
+
+        try:
+            raw = self.redis.get(f"ocr:{key}")
+        except redis.RedisError as e:
+            log.warning("OCR cache (redis) indisponível: %s", e)
+            return None, "miss"
+
+        if raw is None:
+            return None, "miss"
+
+        text = raw.decode("utf-8")
+        self._safe_disk_set(key, text)
+        return text, "redis_hit"
+
+    def set(self, key: str, text: str):
+        self._safe_disk_set(key, text)
+
+        if self.redis is not None:
+            try:
+                self.redis.set(f"ocr:{key}", text.encode("utf-8"), ex=self.ttl)
+            except redis.RedisError as e:
+                log.warning("OCR cache (redis) indisponível: %s", e)
+
+    def _safe_disk_set(self, key: str, text: str):
+        try:
+            self._disk_set(key, text)
+        except OSError as e:
+            log.warning("OCR cache (disco) falhou: %s", e)
+
+
+_cache = None
+
+
+def get_ocr_cache():
+    """Cache do processo, ou None se desabilitado via OCR_CACHE_ENABLED=0."""
+    global _cache
+    if _cache is None and OCR_CACHE_ENABLED:
+        _cache = OcrCache()
+    return _cache
@@ -1,7 +1,19 @@
-import easyocr
 import numpy as np
 import pypdfium2 as pdfium
 import io
+import os
+import json
+import time
+import queue
+import threading
+import contextvars
+
+from app.ocr_cache import cache_key, get_ocr_cache
+from app.metrics import timed, MODEL_LOAD_SECONDS, PAGES, PAGES_PER_JOB
+from app.ocr_layout import (
+    OCR_PREPROCESS, OCR_MAX_SIDE, OCR_DESKEW_MAX_ANGLE, OCR_LAYOUTS,
+    preprocess, find_region, in_anchor_zone, in_region,
+)
 # compatibilidade Pillow >=10 (ANTIALIAS foi movido/removido)
 from PIL import Image
 if not hasattr(Image, "ANTIALIAS"):
@@ -12,7 +24,143 @@ if not hasattr(Image, "ANTIALIAS"):
         # fallback para versões antigas que ainda têm LANCZOS
         Image.ANTIALIAS = getattr(Image, "LANCZOS", 1)
 
-reader = easyocr.Reader(["pt", "en"], gpu=False)
+OCR_LANGUAGES = os.environ.get("OCR_LANGUAGES", "pt,en").split(",")
+
+# torch (CRAFT em PyTorch) | onnx (detector no ONNX Runtime). O reconhecedor
+# continua no PyTorch: em CPU o EasyOCR já o quantiza para int8
+OCR_BACKEND = os.environ.get("OCR_BACKEND", "torch")
+
+# resolução da detecção, independente da renderização (OCR_PDF_DPI), que é
+# a usada pelo reconhecimento: o maior lado é limitado a OCR_DETECT_CANVAS
+OCR_DETECT_CANVAS = int(os.environ.get("OCR_DETECT_CANVAS", 2560))
+OCR_DETECT_MAG_RATIO = float(os.environ.get("OCR_DETECT_MAG_RATIO", 1.0))
+
+# recortes de texto por lote no reconhecedor (o padrão do EasyOCR é 1)
+OCR_RECOG_BATCH_SIZE = int(os.environ.get("OCR_RECOG_BATCH_SIZE", 16))
+
+_reader = None
+_reader_lock = threading.Lock()
+
+PDF_DPI = int(os.environ.get("OCR_PDF_DPI", 200))
+# páginas já renderizadas aguardando o OCR (além da que está sendo lida)
+PDF_PREFETCH = int(os.environ.get("OCR_PDF_PREFETCH", 1))
+
+PAGE_BREAK = "\n\n=== Page Break ===\n\n"
+
+# PDFs digitais: usa o texto embutido quando ele é confiável
+TEXT_LAYER_ENABLED = os.environ.get("OCR_TEXT_LAYER", "1") not in ("0", "false", "False")
+TEXT_LAYER_MIN_CHARS = int(os.environ.get("OCR_TEXT_LAYER_MIN_CHARS", 20))
+TEXT_LAYER_MIN_QUALITY = float(os.environ.get("OCR_TEXT_LAYER_MIN_QUALITY", 0.9))
+TEXT_LAYER_PUNCTUATION = set(".,;:!?()[]/-–+%°ºª'\"*#&@$=<>_|")
+
+# pdfium não é thread-safe: só uma thread produtora o usa por vez
+_pdfium_lock = threading.Lock()
+
+_DONE = object()
+
+
+def get_reader():
+    """
+    Reader do EasyOCR do processo, criado no primeiro uso (importa torch).
+    O worker já o cria no warm-up; importar este módulo continua leve.
+    """
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                start = time.perf_counter()
+                import easyocr
+                reader = easyocr.Reader(OCR_LANGUAGES, gpu=False)
+
+                if OCR_BACKEND == "onnx":
+                    from app.ocr_onnx import onnx_detector
+                    reader.detector = onnx_detector(reader.detector)
+                elif OCR_BACKEND != "torch":
+                    raise ValueError(f"OCR_BACKEND inválido: {OCR_BACKEND} (use torch, onnx)")
+
+                reader.detector = TimedDetector(reader.detector)
+                _reader = reader
+                MODEL_LOAD_SECONDS.labels("easyocr").observe(time.perf_counter() - start)
+    return _reader
+
+
+class TimedDetector:
+    """Mede a detecção à parte (ocr_detect, dentro de ocr_readtext)."""
+
+    def __init__(self, net):
+        self.net = net
+
+    def __call__(self, x):
+        with timed("ocr_detect"):
+            return self.net(x)
+
+
+def recognize(reader, arr, horizontal, free, detail=1):
+    if not horizontal and not free:
+        return []
+    return reader.recognize(
+        arr,
+        horizontal_list=horizontal,
+        free_list=free,
+        detail=detail,
+        batch_size=OCR_RECOG_BATCH_SIZE,
+    )
+
+
+def readtext(arr):
+    """
+    (linhas, layout) da imagem RGB (numpy) — o ``readtext`` do EasyOCR
+    dividido em detecção + reconhecimento, com os ajustes de OCR_*.
+
+    Com OCR_LAYOUTS, a primeira passada reconhece só as caixas da faixa
+    de títulos (margem esquerda). Se elas identificam uma guia TISS, só
+    as caixas da tabela de procedimentos são reconhecidas; senão, as
+    demais caixas da página (já detectadas — nada é refeito).
+    """
+    with timed("ocr_readtext"):
+        reader = get_reader()
+
+        if OCR_PREPROCESS:
+            with timed("ocr_preprocess"):
+                arr = preprocess(arr)
+
+        horizontal, free = reader.detect(
+            arr, canvas_size=OCR_DETECT_CANVAS, mag_ratio=OCR_DETECT_MAG_RATIO,
+        )
+        horizontal, free = horizontal[0], free[0]
+
+        if not OCR_LAYOUTS:
+            return recognize(reader, arr, horizontal, free, detail=0), None
+
+        width = arr.shape[1]
+        anchors = recognize(
+            reader, arr,
+            [b for b in horizontal if in_anchor_zone(b, width)],
+            [b for b in free if in_anchor_zone(b, width)],
+        )
+        horizontal = [b for b in horizontal if not in_anchor_zone(b, width)]
+        free = [b for b in free if not in_anchor_zone(b, width)]
+
+        layout = None
+        region = find_region(anchors)
+
+        if region is not None:
+            name, y0, y1 = region
+            picked = [a for a in anchors if in_region(a[0], y0, y1)]
+            region_h = [b for b in horizontal if in_region(b, y0, y1)]
+            region_f = [b for b in free if in_region(b, y0, y1)]
+
+            # tabela vazia: layout provavelmente errado, fica a página inteira
+            if picked or region_h or region_f:
+                layout = name
+                anchors, horizontal, free = picked, region_h, region_f
+
+        results = anchors + recognize(reader, arr, horizontal, free)
+
+        # mesma ordem do readtext: de cima para baixo
+        results.sort(key=lambda r: r[0][0][1])
+
+        return [text for _, text, _ in results], layout
 
 
 def render_page_to_pil(page, dpi=200):
@@ -23,46 +171,232 @@ def render_page_to_pil(page, dpi=200):
         return page.render_topil(scale=scale)
 
 
-def pdf_to_images(pdf_bytes, dpi=200):
-    pdf = pdfium.PdfDocument(pdf_bytes)
-    images = []
+def ocr_settings(ext: str):
+    """Tudo que altera o texto produzido — entra na chave do cache."""
+    settings = {
+        "engine": "easyocr",
+        "backend": OCR_BACKEND,
+        "languages": OCR_LANGUAGES,
+        "type": ext,
+        "detect_canvas": OCR_DETECT_CANVAS,
+        "detect_mag_ratio": OCR_DETECT_MAG_RATIO,
+        "preprocess": [OCR_MAX_SIDE, OCR_DESKEW_MAX_ANGLE] if OCR_PREPROCESS else None,
+        "layouts": OCR_LAYOUTS,
+    }
+    if ext == "pdf":
+        settings["dpi"] = PDF_DPI
+        settings["text_layer"] = TEXT_LAYER_ENABLED
+    return settings
 
-    for i in range(len(pdf)):
-        page = pdf.get_page(i)
-        pil_img = render_page_to_pil(page, dpi=dpi).convert("RGB")
-        images.append(pil_img)
-        page.close()
 
-    pdf.close()
-    return images
+# =========================================================
+# Camada de texto embutida (PDFs digitais)
+# =========================================================
+def extract_text_layer(page):
+    textpage = page.get_textpage()
+    try:
+        text = textpage.get_text_range()
+    finally:
+        textpage.close()
+
+    lines = (l.strip() for l in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"))
+    return "\n".join(l for l in lines if l)
+
+
+def text_layer_usable(text: str):
+    """
+    A camada de texto só substitui o OCR se parecer texto de verdade:
+    tamanho mínimo, quase nenhum caractere de controle/substituição e
+    palavras reconhecíveis (páginas escaneadas costumam vir vazias ou
+    com lixo de fontes sem mapeamento Unicode).
+    """
+    compact = "".join(text.split())
+    if len(compact) < TEXT_LAYER_MIN_CHARS:
+        return False
+
+    good = sum(1 for ch in compact if ch.isalnum() or ch in TEXT_LAYER_PUNCTUATION)
+    if good / len(compact) < TEXT_LAYER_MIN_QUALITY:
+        return False
+
+    words = text.split()
+    wordlike = sum(1 for w in words if sum(ch.isalpha() for ch in w) >= 2)
+    return wordlike / len(words) >= 0.5
+
+
+def iter_pdf_pages(pdf_bytes, dpi=PDF_DPI, prefetch=PDF_PREFETCH, skip=None,
+                   text_layer=False):
+    """
+    Gera (índice, imagem PIL RGB, texto embutido) página a página — só um
+    dos dois últimos vem preenchido.
+
+    Uma thread produtora renderiza a página N+1 enquanto o consumidor faz
+    OCR da página N; a fila limitada mantém no máximo ``prefetch`` páginas
+    prontas em memória, independente do tamanho do PDF.
+
+    Páginas para as quais ``skip(i)`` é verdadeiro não são renderizadas e
+    saem como (índice, None, None). Com ``text_layer``, páginas cuja camada
+    de texto é utilizável também não são renderizadas.
+    """
+    pages = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        # não bloqueia para sempre se o consumidor desistiu no meio
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            with _pdfium_lock:
+                pdf = pdfium.PdfDocument(pdf_bytes)
+                n_pages = len(pdf)
+
+            try:
+                for i in range(n_pages):
+                    if skip is not None and skip(i):
+                        if not put((i, None, None)):
+                            return
+                        continue
+
+                    img, text = None, None
+
+                    with _pdfium_lock:
+                        page = pdf.get_page(i)
+                        try:
+                            if text_layer:
+                                with timed("text_layer"):
+                                    text = extract_text_layer(page)
+                                if not text_layer_usable(text):
+                                    text = None
+                            if text is None:
+                                with timed("pdf_render"):
+                                    img = render_page_to_pil(page, dpi=dpi)
+                        finally:
+                            page.close()
+
+                    if img is not None and img.mode != "RGB":
+                        img = img.convert("RGB")
+
+                    if not put((i, img, text)):
+                        return
+                    del img
+            finally:
+                with _pdfium_lock:
+                    pdf.close()
+
+            put(_DONE)
+
+        except BaseException as e:
+            put(e)
+
+    # mesmo contexto do consumidor: os tempos de render entram no job
+    ctx = contextvars.copy_context()
+    producer = threading.Thread(target=ctx.run, args=(produce,), name="pdf-render", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = pages.get()
+
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+
+            yield item
+            del item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def pdf_to_images(pdf_bytes, dpi=PDF_DPI):
+    return [img for _, img, _ in iter_pdf_pages(pdf_bytes, dpi=dpi)]
 
 
 def pil_to_numpy(img: Image.Image):
-    return np.array(img).astype(np.uint8)
+    # np.asarray não faz a cópia extra de .astype(np.uint8): imagens RGB
+    # do PIL já são uint8
+    return np.asarray(img)
 
 
-def ocr_image_bytes(image_bytes):
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+def ocr_image(image_bytes):
+    """{"page", "source", "layout", "text"} de uma imagem."""
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
     arr = pil_to_numpy(img)
-    text = reader.readtext(arr, detail=0)
-    return "\n".join(text)
+    del img
+
+    lines, layout = readtext(arr)
+    return {"page": 1, "source": "ocr", "layout": layout, "text": "\n".join(lines)}
+
+
+def ocr_image_bytes(image_bytes):
+    return ocr_image(image_bytes)["text"]
+
+
+def ocr_pdf_pages(pdf_bytes, cache_key=None, text_layer=TEXT_LAYER_ENABLED):
+    """
+    Gera {"page", "source", "text"} de cada página assim que ela termina.
+
+    ``source`` é "text_layer" (texto embutido extraído direto do PDF) ou
+    "ocr" (página escaneada/só imagem). Com ``cache_key``, cada página de
+    OCR tem sua própria entrada no cache: páginas já conhecidas nem são
+    renderizadas (e saem com "cached": True).
+    """
+    cache = get_ocr_cache() if cache_key else None
+    cached = {}
+
+    def skip(i):
+        if cache is None:
+            return False
+        text = cache.get(f"{cache_key}:p{i}")
+        if text is None:
+            return False
+        cached[i] = text
+        return True
 
+    for i, img, text in iter_pdf_pages(pdf_bytes, skip=skip, text_layer=text_layer):
+        if text is not None:
+            yield {"page": i + 1, "source": "text_layer", "text": text}
+            continue
+
+        if img is None:
+            yield {"page": i + 1, "source": "ocr", "cached": True, "text": cached.pop(i)}
+            continue
 
-def ocr_pdf_bytes(pdf_bytes):
-    images = pdf_to_images(pdf_bytes)
-    texts = []
-    for img in images:
         arr = pil_to_numpy(img)
-        result = reader.readtext(arr, detail=0)
-        texts.append("\n".join(result))
-    return "\n\n=== Page Break ===\n\n".join(texts)
+        del img
 
+        lines, layout = readtext(arr)
+        del arr
 
-def ocr_auto(filename=None, file_bytes=None, file_path=None):
+        text = "\n".join(lines)
+        if cache is not None:
+            cache.set(f"{cache_key}:p{i}", text)
+
+        yield {"page": i + 1, "source": "ocr", "layout": layout, "text": text}
+
+
+def ocr_pdf_bytes(pdf_bytes, cache_key=None):
+    return PAGE_BREAK.join(p["text"] for p in ocr_pdf_pages(pdf_bytes, cache_key=cache_key))
+
+
+def ocr_document(filename=None, file_bytes=None, file_path=None):
     """
     Pode receber:
       - filename + file_bytes     (upload direto)
       - file_path                 (arquivo salvo no disco)
+
+    Retorna {"text", "pages"}; ``pages`` diz, por página, se o texto veio
+    da camada embutida do PDF ou do OCR.
     """
 
     # Se veio caminho no disco → abrimos e lemos bytes
@@ -79,12 +413,46 @@ def ocr_auto(filename=None, file_bytes=None, file_path=None):
 
     ext = filename.lower().split(".")[-1]
 
-    if ext == "pdf":
-        return ocr_pdf_bytes(file_bytes)
+    if ext != "pdf" and ext not in ["png", "jpg", "jpeg", "bmp", "tiff"]:
+        raise ValueError(f"Formato não suportado: {ext}")
+
+    # cache por conteúdo: reenvio do mesmo arquivo não refaz o OCR
+    cache = get_ocr_cache()
+    key = None
 
-    elif ext in ["png", "jpg", "jpeg", "bmp", "tiff"]:
-        return ocr_image_bytes(file_bytes)
+    if cache is not None:
+        key = cache_key(file_bytes, ocr_settings(ext))
+        hit = cache.get(key)
+        if hit is not None:
+            result = json.loads(hit)
+            count_pages(result["pages"], cached=True)
+            return result
 
+    if ext == "pdf":
+        texts, pages = [], []
+        for page in ocr_pdf_pages(file_bytes, cache_key=key):
+            texts.append(page.pop("text"))
+            pages.append(page)
+        result = {"text": PAGE_BREAK.join(texts), "pages": pages}
     else:
-        raise ValueError(f"Formato não suportado: {ext}")
+        page = ocr_image(file_bytes)
+        result = {"text": page.pop("text"), "pages": [page]}
+
+    if cache is not None:
+        cache.set(key, json.dumps(result, ensure_ascii=False))
+
+    count_pages(result["pages"])
 
+    return result
+
+
+def count_pages(pages, cached=False):
+    PAGES_PER_JOB.observe(len(pages))
+
+    for page in pages:
+        source = "cached" if cached or page.get("cached") else page["source"]
+        PAGES.labels(source).inc()
+
+
+def ocr_auto(filename=None, file_bytes=None, file_path=None):
+    return ocr_document(filename=filename, file_bytes=file_bytes, file_path=file_path)["text"]
@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+from PIL import Image
+from rapidfuzz import fuzz
+
+from app.catalog import normalize_text
+
+# =========================================================
+# Pré-processamento da página
+# =========================================================
+# cinza + correção de inclinação + redução de imagens grandes
+OCR_PREPROCESS = os.environ.get("OCR_PREPROCESS", "1") not in ("0", "false", "False")
+
+# maior lado da imagem enviada ao OCR; acima disso a página é reduzida
+# (200 DPI de um A4 ≈ 2340 px)
+OCR_MAX_SIDE = int(os.environ.get("OCR_MAX_SIDE", 2400))
+
+# inclinação máxima procurada, em graus (0 = sem deskew)
+OCR_DESKEW_MAX_ANGLE = float(os.environ.get("OCR_DESKEW_MAX_ANGLE", 5))
+
+# recorte por layout (guias TISS): só a tabela de procedimentos vai ao
+# reconhecedor; sem layout conhecido, a página inteira
+OCR_LAYOUTS = os.environ.get("OCR_LAYOUTS", "1") not in ("0", "false", "False")
+
+# faixa à esquerda (fração da largura) onde ficam os títulos de seção
+OCR_LAYOUT_ANCHOR_ZONE = float(os.environ.get("OCR_LAYOUT_ANCHOR_ZONE", 0.12))
+OCR_LAYOUT_MIN_SCORE = float(os.environ.get("OCR_LAYOUT_MIN_SCORE", 85))
+
+DESKEW_THUMB_SIDE = 800
+DESKEW_STEP = 0.25
+DESKEW_MIN_ANGLE = 0.2
+
+
+def to_gray(img: Image.Image):
+    return img if img.mode == "L" else img.convert("L")
+
+
+def downscale(img: Image.Image, max_side: int = OCR_MAX_SIDE):
+    side = max(img.size)
+    if not max_side or side <= max_side:
+        return img
+    scale = max_side / side
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.LANCZOS)
+
+
+def skew_angle(gray: Image.Image, max_angle: float = OCR_DESKEW_MAX_ANGLE):
+    """
+    Ângulo (graus, anti-horário) que deixa as linhas de texto na
+    horizontal: o que maximiza a variância da soma de tinta por linha
+    de pixels, numa miniatura binarizada.
+    """
+    if max_angle <= 0:
+        return 0.0
+
+    thumb = gray.copy()
+    thumb.thumbnail((DESKEW_THUMB_SIDE, DESKEW_THUMB_SIDE))
+
+    arr = np.asarray(thumb)
+    ink = Image.fromarray(((arr < arr.mean() * 0.75) * 255).astype(np.uint8))
+
+    best, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + DESKEW_STEP / 2, DESKEW_STEP):
+        rows = np.asarray(ink.rotate(angle, resample=Image.NEAREST), dtype=np.float32).sum(axis=1)
+        score = float(rows.var())
+        if score > best_score:
+            best, best_score = float(angle), score
+
+    return best
+
+
+def preprocess(arr):
+    """Imagem RGB (numpy) → cinza, sem inclinação e no máximo OCR_MAX_SIDE."""
+    img = to_gray(Image.fromarray(arr))
+
+    # reduz antes: o deskew e o OCR trabalham em menos pixels
+    img = downscale(img)
+
+    angle = skew_angle(img)
+    if abs(angle) >= DESKEW_MIN_ANGLE:
+        img = img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+    return np.asarray(img)
+
+
+# =========================================================
+# Layouts conhecidos — guias TISS
+# =========================================================
+# "start": título da seção com a tabela de procedimentos; "end": títulos
+# que podem vir logo depois dela. Textos já normalizados (normalize_text)
+LAYOUTS = (
+    {
+        "name": "tiss_sp_sadt",
+        "start": ("procedimentos e exames solicitados",),
+        "end": (
+            "dados do contratado executante",
+            "dados do atendimento",
+            "procedimentos e exames realizados",
+            "opm solicitados",
+            "observacao",
+        ),
+    },
+    {
+        "name": "tiss_internacao",
+        "start": ("procedimentos solicitados",),
+        "end": (
+            "opm solicitados",
+            "dados da autorizacao",
+            "observacao",
+            "assinatura",
+        ),
+    },
+)
+
+
+def box_bounds(box):
+    """(x_min, y_min, y_max) de uma caixa do EasyOCR: [x0, x1, y0, y1] ou 4 pontos."""
+    if len(box) == 4 and not isinstance(box[0], (list, tuple, np.ndarray)):
+        return box[0], box[2], box[3]
+    xs = [p[0] for p in box]
+    ys = [p[1] for p in box]
+    return min(xs), min(ys), max(ys)
+
+
+def in_anchor_zone(box, width: int):
+    return box_bounds(box)[0] < width * OCR_LAYOUT_ANCHOR_ZONE
+
+
+def _matches(text: str, titles):
+    return any(fuzz.partial_ratio(title, text) >= OCR_LAYOUT_MIN_SCORE for title in titles)
+
+
+def find_region(anchors):
+    """
+    Layout e faixa vertical (y0, y1) da tabela de procedimentos, a partir
+    dos textos da faixa de títulos [(pontos, texto, conf)], ou None.
+    """
+    anchors = sorted(
+        ((box_bounds(points), normalize_text(text)) for points, text, _ in anchors),
+        key=lambda a: a[0][1],
+    )
+
+    for layout in LAYOUTS:
+        for (_, _, start_bottom), text in anchors:
+            if not _matches(text, layout["start"]):
+                continue
+
+            end = next(
+                (y0 for (_, y0, _), t in anchors if y0 > start_bottom and _matches(t, layout["end"])),
+                float("inf"),
+            )
+            return layout["name"], start_bottom, end
+
+    return None
+
+
+def in_region(box, y0, y1):
+    _, top, bottom = box_bounds(box)
+    return y0 <= (top + bottom) / 2 < y1
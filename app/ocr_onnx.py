@@ -0,0 +1,86 @@
+import os
+import threading
+
+import numpy as np
+
+from app.encoder import export_lock, session_options
+
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+
+# detector CRAFT exportado para ONNX, gerado no primeiro uso
+OCR_ONNX_DIR = os.environ.get("OCR_ONNX_DIR", os.path.join(DATA_DIR, "onnx", "easyocr"))
+
+
+class OnnxDetector:
+    """
+    Substitui ``reader.detector`` (CRAFT em PyTorch) pelo mesmo grafo no
+    ONNX Runtime. O EasyOCR chama ``net(x)`` com o lote já redimensionado
+    e normalizado e só usa o mapa de score/link (``y``).
+
+    A sessão é criada por processo, no primeiro uso (ver OnnxEncoder).
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        pid = os.getpid()
+        if self._session_pid != pid:
+            with self._lock:
+                if self._session_pid != pid:
+                    import onnxruntime as ort
+
+                    self._session = ort.InferenceSession(
+                        self.model_path, session_options(), providers=["CPUExecutionProvider"]
+                    )
+                    self._session_pid = pid
+        return self._session
+
+    def __call__(self, x):
+        import torch
+
+        feed = {"image": x.cpu().numpy().astype(np.float32)}
+        y = self._get_session().run(["y"], feed)[0]
+        return torch.from_numpy(y), None
+
+
+def export_detector(detector, path: str):
+    """CRAFT do reader → ONNX com altura/largura dinâmicas."""
+    import torch
+
+    tmp = f"{path}.tmp.{os.getpid()}"
+
+    with torch.no_grad():
+        torch.onnx.export(
+            detector,
+            torch.zeros(1, 3, 640, 640),
+            tmp,
+            input_names=["image"],
+            output_names=["y", "feature"],
+            dynamic_axes={
+                "image": {0: "batch", 2: "height", 3: "width"},
+                "y": {0: "batch", 1: "height", 2: "width"},
+                "feature": {0: "batch", 2: "height", 3: "width"},
+            },
+            opset_version=14,
+        )
+
+    os.replace(tmp, path)
+
+
+def onnx_detector(detector, onnx_dir: str = OCR_ONNX_DIR):
+    import easyocr
+
+    # pesos do detector vêm com o pacote: um arquivo por versão do EasyOCR
+    path = os.path.join(onnx_dir, f"craft-{easyocr.__version__}.onnx")
+
+    if not os.path.exists(path):
+        # vários workers subindo juntos: só um exporta
+        with export_lock(onnx_dir):
+            if not os.path.exists(path):
+                export_detector(detector, path)
+
+    return OnnxDetector(path)
@@ -0,0 +1,43 @@
+import os
+import json
+
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+
+# texto OCR de cada documento, guardado para refazer só o match
+# (ex.: depois de atualizar o catálogo) sem repetir o OCR
+OCR_TEXT_DIR = os.environ.get("OCR_TEXT_DIR", os.path.join(DATA_DIR, "ocr_texts"))
+
+
+def document_id(filename: str):
+    """Uploads são salvos como <sha256>.<tipo>: o id é o sha256."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _path(doc_id: str):
+    return os.path.join(OCR_TEXT_DIR, f"{doc_id}.json")
+
+
+def save_ocr_result(doc_id: str, payload: dict):
+    os.makedirs(OCR_TEXT_DIR, exist_ok=True)
+
+    path = _path(doc_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+    return path
+
+
+def load_ocr_result(doc_id: str):
+    """Payload salvo por save_ocr_result, ou None se não existir."""
+    try:
+        with open(_path(doc_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def has_ocr_result(doc_id: str):
+    return os.path.exists(_path(doc_id))
@@ -1,72 +1,465 @@
 import os
+import gc
+import time
 import uuid
+import shutil
+import logging
 import traceback
 
-from celery import Celery
-from fastapi import UploadFile
-from app.ocr_engine import ocr_auto
+import numpy as np
+from celery.signals import (
+    worker_init, worker_process_init, worker_process_shutdown, worker_shutdown,
+)
+
+from app.celery_app import (
+    celery_app, OCR_TASK, OCR_BATCH_TASK, MATCH_TASK, MATCH_BATCH_TASK,
+)
+from app.ocr_engine import ocr_document, get_reader
+from app.ocr_store import document_id, save_ocr_result, load_ocr_result
 from app.matcher import get_matcher
-from app.log_utils import save_debug_log
+from app.log_utils import save_debug_log, flush_logs
+from app.metrics import (
+    timed, observe, job_timings, JOBS,
+    start_metrics_server, clear_multiprocess_dir, mark_process_dead,
+)
 
 DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
 UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
 
+# criado só depois do warm-up de todos os processos — healthcheck do container
+WORKER_READY_FILE = os.environ.get("WORKER_READY_FILE", "/tmp/ocr_worker.ready")
+
+# um arquivo por pid de filho já aquecido
+WORKER_READY_DIR = WORKER_READY_FILE + ".children"
+
+# prefork: carrega modelos e índice no processo pai, antes do fork — os
+# filhos compartilham as páginas (copy-on-write) em vez de cada um
+# carregar a sua cópia
+WORKER_PRELOAD = os.environ.get("WORKER_PRELOAD", "1") not in ("0", "false", "False")
+
+# modelos que este worker carrega no warm-up: "ocr" (fila ocr),
+# "match" (fila match) ou ambos
+WORKER_MODELS = {
+    m.strip() for m in os.environ.get("WORKER_MODELS", "ocr,match").split(",") if m.strip()
+}
+
+# threads intra-op do torch por filho; 0 = núcleos disponíveis ao
+# container (afinidade e cota do cgroup) / concorrência
+WORKER_TORCH_THREADS = int(os.environ.get("WORKER_TORCH_THREADS", 0))
+
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-BROKER = os.environ.get("CELERY_BROKER_URL", "redis://ocr_redis:6379/0")
-BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://ocr_redis:6379/1")
+log = logging.getLogger(__name__)
+
+_ready = False
+
+# concorrência do pool, lida no pai e herdada pelos filhos no fork
+_concurrency = 1
 
-celery_app = Celery("tasks", broker=BROKER, backend=BACKEND)
 
+# =========================================================
+# Threads — os filhos dividem os núcleos entre si
+# =========================================================
+def _cgroup_cpu_limit():
+    """Núcleos da cota de CPU do container (docker --cpus), ou None."""
+    try:
+        # cgroup v2: "max 100000" (sem limite) ou "200000 100000"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+
+    return None
 
-@celery_app.task(name="app.tasks.ocr_task")
-def ocr_task(filename: str):
+
+def available_cpus():
     """
-    Executa o OCR + Match e gera log explicando decisões.
+    Núcleos que o processo pode usar de fato: afinidade (cpuset) e cota do
+    cgroup — ``os.cpu_count()`` conta os núcleos do host inteiro.
     """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # sem sched_getaffinity (macOS)
+        cpus = os.cpu_count() or 1
 
-    job_id = str(uuid.uuid4())
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, int(limit)))
+
+    return max(1, cpus)
 
-    upload_path = os.path.join(UPLOAD_DIR, filename)
 
-    matcher = get_matcher()
+def threads_per_child(concurrency: int):
+    # WORKER_TORCH_THREADS sempre vence a detecção
+    if WORKER_TORCH_THREADS > 0:
+        return WORKER_TORCH_THREADS
+    return max(1, available_cpus() // max(1, concurrency))
 
+
+def set_torch_threads(n: int):
+    import torch
+    import faiss
+    from app import encoder
+
+    torch.set_num_threads(n)
+    faiss.omp_set_num_threads(n)
+    encoder.set_num_threads(n)  # sessões ONNX Runtime (embeddings e detector OCR)
+
+
+# =========================================================
+# Warm-up — modelos carregados uma vez por processo, antes
+# da primeira task (e não no import)
+# =========================================================
+def load_models():
+    if "ocr" in WORKER_MODELS:
+        get_reader()
+    if "match" in WORKER_MODELS:
+        get_matcher()
+
+
+def warm_up():
+    global _ready
+
+    # já carregados no pai (preload): aqui só devolvem os mesmos objetos
+    load_models()
+
+    # primeira inferência fora da primeira task (cria as sessões ONNX do
+    # processo); nunca no pai do prefork — warm_up só roda no filho/solo
+    if "ocr" in WORKER_MODELS:
+        get_reader().readtext(np.full((64, 64, 3), 255, dtype=np.uint8), detail=0)
+    if "match" in WORKER_MODELS:
+        get_matcher().encoder.encode(["aquecimento"])
+
+    _ready = True
+    mark_ready()
+
+
+def _alive(pid: int):
     try:
-        # OCR (usando file_path)
-        text = ocr_auto(file_path=upload_path)
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
-        # match codes
-        codes = matcher.match_codes_from_text(text)
 
-        debug_payload = {
-            "filename": filename,
-            "job_id": job_id,
-            "ocr_text": text,
-            "codes": codes,
-            "decision_trace": matcher.debug_trace,
-        }
+def mark_ready():
+    """
+    Marca este processo como aquecido e, quando os ``_concurrency``
+    processos do pool estão prontos, cria WORKER_READY_FILE — o primeiro
+    filho aquecido não deixa o container saudável sozinho. Marcas de
+    filhos já mortos (substituídos pelo pool) não contam.
+    """
+    pid = os.getpid()
+
+    os.makedirs(WORKER_READY_DIR, exist_ok=True)
+    open(os.path.join(WORKER_READY_DIR, str(pid)), "w").close()
+
+    ready = [
+        name for name in os.listdir(WORKER_READY_DIR)
+        if name.isdigit() and _alive(int(name))
+    ]
+
+    log.info("processo %s pronto (%s de %s)", pid, len(ready), _concurrency)
+
+    if len(ready) >= _concurrency:
+        with open(WORKER_READY_FILE, "w") as f:
+            f.write(" ".join(sorted(ready)))
+        log.info("worker pronto (%s processos)", len(ready))
+
+
+def is_ready():
+    return _ready
+
+
+def preload():
+    """
+    Carrega reader e matcher no pai do prefork, sem rodar inferência.
+
+    O torch fica com 1 thread aqui: um pool OpenMP já ativo no pai pode
+    travar os filhos depois do fork. ``gc.freeze()`` move tudo o que foi
+    carregado para a geração permanente — o GC dos filhos não reescreve
+    esses objetos e as páginas continuam compartilhadas.
+    """
+    set_torch_threads(1)
+
+    load_models()
+
+    gc.collect()
+    gc.freeze()
+
+    log.info("modelos carregados no processo pai (pid %s)", os.getpid())
+
+
+@worker_process_init.connect
+def warm_up_process(**kwargs):
+    # prefork: cada filho usa a sua fatia dos núcleos
+    n = threads_per_child(_concurrency)
+    set_torch_threads(n)
+
+    log.info("filho %s com %s threads", os.getpid(), n)
+
+    warm_up()
+
+
+@worker_init.connect
+def init_worker(sender=None, **kwargs):
+    global _concurrency
+
+    # arquivo de um worker anterior não vale para este
+    clear_ready()
+
+    # um servidor por worker (no pai): no prefork agrega os filhos
+    clear_multiprocess_dir()
+    start_metrics_server()
+
+    # pools sem processos filhos (solo, threads): worker_process_init
+    # nunca dispara — o warm-up é no próprio processo
+    pool = str(getattr(sender, "pool_cls", None) or "prefork").lower()
+    if "prefork" not in pool:
+        warm_up()
+        return
+
+    _concurrency = getattr(sender, "concurrency", None) or 1
+
+    if WORKER_PRELOAD:
+        preload()
+
+
+@worker_shutdown.connect
+def clear_ready(**kwargs):
+    try:
+        os.remove(WORKER_READY_FILE)
+    except OSError:
+        pass
+
+    shutil.rmtree(WORKER_READY_DIR, ignore_errors=True)
+
+
+@worker_process_shutdown.connect
+def clear_process_ready(pid=None, **kwargs):
+    try:
+        os.remove(os.path.join(WORKER_READY_DIR, str(pid or os.getpid())))
+    except OSError:
+        pass
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_debug_logs(**kwargs):
+    # logs ainda na fila do writer: grava antes do processo sair
+    flush_logs()
+
+
+@worker_process_shutdown.connect
+def release_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+
+def observe_queue_wait(task, stage: str):
+    """Tempo na fila: carimbo ``sent_at`` de app.celery_app até agora."""
+    sent_at = getattr(task.request, "sent_at", None)
+    if sent_at:
+        observe(stage, max(0.0, time.time() - sent_at))
+
 
-        log_path = save_debug_log(job_id, debug_payload)
+# =========================================================
+# OCR (fila ocr) — o texto segue para o match e fica salvo
+# =========================================================
+def run_ocr(filename: str):
+    """Documento OCR pronto para o match, ou com ``error`` se falhou."""
+    upload_path = os.path.join(UPLOAD_DIR, filename)
+    doc_id = document_id(filename)
 
+    try:
+        # OCR (usando file_path) — texto embutido direto nos PDFs digitais
+        ocr = ocr_document(file_path=upload_path)
+    except Exception as e:
         return {
-            "job_id": job_id,
-            "codes": codes,
-            "log_path": log_path,
+            "filename": filename,
+            "document_id": doc_id,
+            "error": str(e),
+            "traceback": traceback.format_exc(),
         }
 
+    doc = {
+        "filename": filename,
+        "document_id": doc_id,
+        "text": ocr["text"],
+        "pages": ocr["pages"],
+    }
+
+    save_ocr_result(doc_id, doc)
+
+    return doc
+
+
+def timed_ocr(filename: str):
+    # tempos por etapa do documento seguem para o match (e o resultado)
+    with job_timings() as timings:
+        with timed("ocr"):
+            doc = run_ocr(filename)
+
+    doc["timings"] = timings
+    JOBS.labels("ocr", "error" if "error" in doc else "ok").inc()
+
+    return doc
+
+
+@celery_app.task(name=OCR_TASK, bind=True)
+def ocr_task(self, filename: str):
+    with job_timings() as timings:
+        observe_queue_wait(self, "ocr_queue_wait")
+
+    doc = timed_ocr(filename)
+    doc["timings"].update(timings)
+    return doc
+
+
+@celery_app.task(name=OCR_BATCH_TASK, bind=True)
+def ocr_batch_task(self, filenames):
+    with job_timings() as timings:
+        observe_queue_wait(self, "ocr_queue_wait")
+
+    # falha de um arquivo não derruba o lote
+    docs = [timed_ocr(filename) for filename in filenames]
+
+    for doc in docs:
+        doc["timings"].update(timings)
+
+    return docs
+
+
+# =========================================================
+# Match (fila match)
+# =========================================================
+def with_stored_text(doc: dict):
+    """
+    Rematch: documento só com ``document_id`` usa o texto OCR salvo.
+    """
+    if "text" in doc or "error" in doc:
+        return doc
+
+    stored = load_ocr_result(doc["document_id"])
+    if stored is None:
+        return {**doc, "error": "texto OCR não encontrado", "traceback": None}
+
+    return stored
+
+
+def match_documents(docs, job_ids):
+    """
+    Um único match para todos os documentos: as linhas ambíguas dividem
+    os mesmos lotes de embeddings. Gera log e resultado por documento,
+    na ordem recebida.
+    """
+    docs = [with_stored_text(doc) for doc in docs]
+    ok = [doc for doc in docs if "error" not in doc]
+
+    try:
+        with timed("match"):
+            matches = get_matcher().match_many([doc["text"] for doc in ok])
     except Exception as e:
         err = traceback.format_exc()
+        for doc in ok:
+            doc["error"] = str(e)
+            doc["traceback"] = err
+        matches = []
 
-        debug_payload = {
-            "filename": filename,
+    for doc, (codes, trace, version) in zip(ok, matches):
+        doc["codes"] = codes
+        doc["trace"] = trace
+        doc["catalog_version"] = version
+
+    results = []
+
+    for doc, job_id in zip(docs, job_ids):
+        JOBS.labels("match", "error" if "error" in doc else "ok").inc()
+
+        if "error" in doc:
+            save_debug_log(job_id, {
+                "filename": doc.get("filename"),
+                "job_id": job_id,
+                "error": doc["error"],
+                "traceback": doc["traceback"],
+            })
+
+            results.append({
+                "filename": doc.get("filename"),
+                "job_id": job_id,
+                "error": "matcher internal error",
+                "details": doc["error"],
+            })
+            continue
+
+        with timed("log_write"):
+            log_path = save_debug_log(job_id, {
+                "filename": doc["filename"],
+                "job_id": job_id,
+                "document_id": doc["document_id"],
+                "ocr_text": doc["text"],
+                "pages": doc["pages"],
+                "codes": doc["codes"],
+                "catalog_version": doc["catalog_version"],
+                "decision_trace": doc["trace"],
+            })
+
+        results.append({
+            "filename": doc["filename"],
             "job_id": job_id,
-            "error": str(e),
-            "traceback": err,
-        }
+            "document_id": doc["document_id"],
+            "codes": doc["codes"],
+            "catalog_version": doc["catalog_version"],
+            "pages": doc["pages"],
+            "log_path": log_path,
+            "timings": doc.get("timings", {}),
+        })
 
-        save_debug_log(job_id, debug_payload)
+    return results
 
-        return {
-            "error": "matcher internal error",
-            "details": str(e),
-        }
+
+@celery_app.task(name=MATCH_TASK, bind=True)
+def match_task(self, doc: dict):
+    """
+    Match de um documento (resultado do ocr_task, ou {"document_id"}
+    para refazer o match sobre o texto salvo). O id da task é o job_id.
+    """
+    job_id = self.request.id or str(uuid.uuid4())
+
+    with job_timings() as timings:
+        observe_queue_wait(self, "match_queue_wait")
+        result = match_documents([doc], [job_id])[0]
+
+    if "timings" in result:
+        result["timings"].update(timings)
+
+    return result
+
+
+@celery_app.task(name=MATCH_BATCH_TASK, bind=True)
+def match_batch_task(self, docs):
+    # etapas do match são do lote inteiro (lotes de embeddings comuns)
+    with job_timings() as timings:
+        observe_queue_wait(self, "match_queue_wait")
+        results = match_documents(docs, [str(uuid.uuid4()) for _ in docs])
+
+    for result in results:
+        if "timings" in result:
+            result["timings"].update(timings)
+
+    return results
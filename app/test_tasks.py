@@ -1,5 +1,5 @@
 # app/test_tasks.py
-from app.tasks import celery_app
+from app.celery_app import celery_app
 
 @celery_app.task(bind=True)
 def ping(self, x):
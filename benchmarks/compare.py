@@ -0,0 +1,75 @@
+"""
+Compara dois resultados de benchmarks/run.py (ex.: main x branch).
+
+Uso:
+    python benchmarks/compare.py base.json novo.json
+    python benchmarks/compare.py base.json novo.json --max-accuracy-drop 0.01
+
+Sai com código 1 se precisão ou recall caírem mais que a tolerância.
+"""
+
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def delta(a, b):
+    if not a:
+        return "     n/a"
+    return f"{(b - a) / a * 100:+7.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara dois resultados de benchmark")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.0)
+    args = parser.parse_args()
+
+    base, new = load(args.base), load(args.new)
+
+    print(f"base: {base['meta'].get('branch')} {str(base['meta'].get('commit'))[:10]}")
+    print(f"novo: {new['meta'].get('branch')} {str(new['meta'].get('commit'))[:10]}")
+
+    print(f"\n{'etapa':<22}{'p50 base':>10}{'p50 novo':>10}{'Δ':>9}{'p90 base':>10}{'p90 novo':>10}{'Δ':>9}")
+    for stage in sorted(set(base["stages"]) | set(new["stages"])):
+        a = base["stages"].get(stage)
+        b = new["stages"].get(stage)
+        if a is None or b is None:
+            print(f"{stage:<22}{'(só em ' + ('novo' if a is None else 'base') + ')':>20}")
+            continue
+        print(
+            f"{stage:<22}{a['p50']:>10.4f}{b['p50']:>10.4f}{delta(a['p50'], b['p50']):>9}"
+            f"{a['p90']:>10.4f}{b['p90']:>10.4f}{delta(a['p90'], b['p90']):>9}"
+        )
+
+    print()
+    for key in sorted(set(base["throughput"]) & set(new["throughput"])):
+        a, b = base["throughput"][key], new["throughput"][key]
+        print(f"{key:<28}{a:>10}{b:>10}{delta(a, b):>9}")
+
+    for key in ("peak_rss_mb_after_load", "peak_rss_mb"):
+        a, b = base["memory"].get(key), new["memory"].get(key)
+        if a is not None and b is not None:
+            print(f"{key:<28}{a:>10}{b:>10}{delta(a, b):>9}")
+
+    print()
+    regressed = False
+    for key in ("precision", "recall", "f1"):
+        a, b = base["accuracy"][key], new["accuracy"][key]
+        print(f"{key:<28}{a:>10.4f}{b:>10.4f}{b - a:>+9.4f}")
+        if key != "f1" and a - b > args.max_accuracy_drop:
+            regressed = True
+
+    if regressed:
+        print("\nREGRESSÃO de acurácia acima da tolerância")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
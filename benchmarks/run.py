@@ -0,0 +1,276 @@
+"""
+Benchmark + regressão de acurácia do pipeline (OCR + matcher).
+
+Reproduz os documentos de exemplo (``data/uploads``) e os casos rotulados
+(``benchmarks/cases.json``: texto OCR ou arquivo + códigos esperados) e
+mede latência por etapa (p50/p90/p99), throughput, pico de RSS e
+precisão/recall do matcher. O resultado em JSON permite comparar branches
+com ``benchmarks/compare.py``.
+
+Uso:
+    python benchmarks/run.py
+    python benchmarks/run.py --skip-ocr --repeat 5
+    python benchmarks/run.py --out benchmarks/results/minha-branch.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_CASES = os.path.join(ROOT, "benchmarks", "cases.json")
+DEFAULT_UPLOADS = os.path.join(ROOT, "data", "uploads")
+DEFAULT_RESULTS = os.path.join(ROOT, "benchmarks", "results")
+
+UPLOAD_TYPES = (".pdf", ".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark do OCR + matcher")
+    parser.add_argument("--cases", default=DEFAULT_CASES, help="casos rotulados (JSON)")
+    parser.add_argument("--uploads", default=DEFAULT_UPLOADS, help="documentos sem rótulo para replay do OCR")
+    parser.add_argument("--skip-ocr", action="store_true", help="só o matcher (casos com texto)")
+    parser.add_argument("--ocr-cache", action="store_true", help="mantém o cache de OCR ligado")
+    parser.add_argument("--match-cache", action="store_true", help="mantém o cache linha → decisão ligado")
+    parser.add_argument("--repeat", type=int, default=3, help="repetições de cada documento")
+    parser.add_argument("--out", help="arquivo JSON de saída (padrão: benchmarks/results/<branch>-<data>.json)")
+    return parser.parse_args()
+
+
+def git(*args):
+    try:
+        return subprocess.check_output(["git", *args], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    # Linux: ru_maxrss em KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentiles(values):
+    import numpy as np
+
+    arr = np.asarray(values, dtype=float)
+    return {
+        "n": int(arr.size),
+        "mean": round(float(arr.mean()), 4),
+        "p50": round(float(np.percentile(arr, 50)), 4),
+        "p90": round(float(np.percentile(arr, 90)), 4),
+        "p99": round(float(np.percentile(arr, 99)), 4),
+    }
+
+
+def load_documents(args):
+    """Casos rotulados + uploads não rotulados, como dicts {"id", "text"|"file", "expected"}."""
+    with open(args.cases, "r", encoding="utf-8") as f:
+        docs = json.load(f)
+
+    for doc in docs:
+        if "file" in doc and not os.path.isabs(doc["file"]):
+            doc["file"] = os.path.join(ROOT, doc["file"])
+
+    labeled_files = {doc["file"] for doc in docs if "file" in doc}
+
+    if os.path.isdir(args.uploads):
+        for name in sorted(os.listdir(args.uploads)):
+            path = os.path.join(args.uploads, name)
+            if name.lower().endswith(UPLOAD_TYPES) and path not in labeled_files:
+                docs.append({"id": f"uploads/{name}", "file": path, "expected": None})
+
+    if args.skip_ocr:
+        docs = [doc for doc in docs if "text" in doc]
+
+    return docs
+
+
+def score(expected, found):
+    expected, found = set(expected), set(found)
+    return {
+        "tp": len(expected & found),
+        "fp": sorted(found - expected),
+        "fn": sorted(expected - found),
+    }
+
+
+def main():
+    args = parse_args()
+
+    # OCR e match de verdade a cada repetição, não leitura dos caches
+    if not args.ocr_cache:
+        os.environ["OCR_CACHE_ENABLED"] = "0"
+    if not args.match_cache:
+        os.environ["MATCH_CACHE_ENABLED"] = "0"
+
+    from app.metrics import job_timings, timed
+    from app.matcher import get_matcher, THRESHOLD
+    from app.encoder import MODEL_NAME, EMBEDDING_BACKEND
+    from app.embedding_index import INDEX_TYPE
+    from app.ocr_engine import OCR_BACKEND, OCR_DETECT_CANVAS, OCR_RECOG_BATCH_SIZE
+    from app.ocr_layout import OCR_PREPROCESS, OCR_LAYOUTS
+
+    docs = load_documents(args)
+
+    # --------------------------------------------------
+    # Carga dos modelos
+    # --------------------------------------------------
+    load = {}
+
+    start = time.perf_counter()
+    matcher = get_matcher()
+    load["matcher"] = round(time.perf_counter() - start, 3)
+
+    if any("file" in doc for doc in docs):
+        from app.ocr_engine import ocr_document, get_reader
+
+        start = time.perf_counter()
+        get_reader()
+        load["ocr_reader"] = round(time.perf_counter() - start, 3)
+
+    rss_after_load = peak_rss_mb()
+
+    # --------------------------------------------------
+    # Documento a documento: OCR (se houver) + match
+    # --------------------------------------------------
+    stages = {}
+    results = {}
+    texts = {}
+
+    wall_start = time.perf_counter()
+
+    for _ in range(max(1, args.repeat)):
+        for doc in docs:
+            with job_timings() as timings:
+                with timed("total"):
+                    if "text" in doc:
+                        text = doc["text"]
+                    else:
+                        with timed("ocr"):
+                            text = ocr_document(file_path=doc["file"])["text"]
+
+                    with timed("match"):
+                        codes, _, _ = matcher.match_many([text])[0]
+
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+
+            results[doc["id"]] = codes
+            texts[doc["id"]] = text
+
+    wall = time.perf_counter() - wall_start
+    n_docs = len(docs) * max(1, args.repeat)
+
+    # --------------------------------------------------
+    # Match em lote (todos os textos num único match_many)
+    # --------------------------------------------------
+    all_texts = list(texts.values())
+
+    start = time.perf_counter()
+    for _ in range(max(1, args.repeat)):
+        matcher.match_many(all_texts)
+    batch_wall = time.perf_counter() - start
+
+    n_lines = sum(len([l for l in t.splitlines() if l.strip()]) for t in all_texts)
+
+    # --------------------------------------------------
+    # Acurácia (só casos rotulados)
+    # --------------------------------------------------
+    cases = []
+    tp = fp = fn = 0
+
+    for doc in docs:
+        if doc.get("expected") is None:
+            continue
+
+        s = score(doc["expected"], results[doc["id"]])
+        tp += s["tp"]
+        fp += len(s["fp"])
+        fn += len(s["fn"])
+        cases.append({"id": doc["id"], "found": results[doc["id"]], **s})
+
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+    report = {
+        "meta": {
+            "commit": git("rev-parse", "HEAD"),
+            "branch": git("rev-parse", "--abbrev-ref", "HEAD"),
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "documents": len(docs),
+            "embedding_model": MODEL_NAME,
+            "embedding_backend": EMBEDDING_BACKEND,
+            "index_type": INDEX_TYPE,
+            "threshold": THRESHOLD,
+            "ocr_cache": args.ocr_cache,
+            "match_cache": args.match_cache,
+            "ocr_backend": OCR_BACKEND,
+            "ocr_detect_canvas": OCR_DETECT_CANVAS,
+            "ocr_recog_batch_size": OCR_RECOG_BATCH_SIZE,
+            "ocr_preprocess": OCR_PREPROCESS,
+            "ocr_layouts": OCR_LAYOUTS,
+        },
+        "load_seconds": load,
+        "stages": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        "throughput": {
+            "docs_per_s": round(n_docs / wall, 3),
+            "match_batch_docs_per_s": round(len(all_texts) * max(1, args.repeat) / batch_wall, 3),
+            "match_batch_lines_per_s": round(n_lines * max(1, args.repeat) / batch_wall, 1),
+        },
+        "memory": {
+            "peak_rss_mb_after_load": rss_after_load,
+            "peak_rss_mb": peak_rss_mb(),
+        },
+        "accuracy": {
+            "precision": round(precision, 4),
+            "recall": round(recall, 4),
+            "f1": round(f1, 4),
+            "tp": tp,
+            "fp": fp,
+            "fn": fn,
+            "cases": cases,
+        },
+    }
+
+    out = args.out
+    if out is None:
+        branch = (report["meta"]["branch"] or "local").replace("/", "_")
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(DEFAULT_RESULTS, f"{branch}-{stamp}.json")
+
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    # --------------------------------------------------
+    # Resumo
+    # --------------------------------------------------
+    print(f"\n{'etapa':<22}{'n':>6}{'p50':>10}{'p90':>10}{'p99':>10}")
+    for stage, p in report["stages"].items():
+        print(f"{stage:<22}{p['n']:>6}{p['p50']:>10.4f}{p['p90']:>10.4f}{p['p99']:>10.4f}")
+
+    print(f"\nthroughput: {report['throughput']}")
+    print(f"memória:    {report['memory']}")
+    print(f"acurácia:   precision={precision:.3f} recall={recall:.3f} f1={f1:.3f}")
+
+    for case in cases:
+        if case["fp"] or case["fn"]:
+            print(f"  {case['id']}: fp={case['fp']} fn={case['fn']}")
+
+    print(f"\nresultado salvo em {out}")
+
+
+if __name__ == "__main__":
+    main()
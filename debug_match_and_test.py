@@ -58,15 +58,14 @@ print(f"PROCEDURES_CSV env: {os.environ.get('PROCEDURES_CSV')}")
 print(f"MATCHER_THRESHOLD env: {os.environ.get('MATCHER_THRESHOLD')}")
 
 print("\n--- Matcher basic summary ---")
-print("type(_index_by_code):", type(matcher._index_by_code))
-print("len(_index_by_code):", len(matcher._index_by_code))
-print("len(_descs):", len(matcher._descs))
-print("_rf_choices present?:", bool(matcher._rf_choices))
-
-# Mostrar algumas chaves
-print("\nSample first 20 keys (repr):")
-for i, k in enumerate(list(matcher._index_by_code.keys())[:20]):
-    print(f"- {repr(k)}")
+print("len(catalog):", len(matcher.catalog))
+print("chaves léxicas (rapidfuzz):", len(matcher.lexical._choices))
+print("índice:", type(matcher.index).__name__)
+
+# Mostrar alguns códigos
+print("\nSample first 20 codes (repr):")
+for i in range(min(20, len(matcher.catalog))):
+    print(f"- {repr(matcher.catalog.code(i))}")
 print()
 
 # --------------------------------------------------------------------------------------
@@ -81,7 +80,7 @@ except Exception:
     sys.exit(2)
 
 # --------------------------------------------------------------------------------------
-header("3) Fuzzy debugging (apenas scores >= 93)")
+header(f"3) Fuzzy debugging (apenas scores >= {FUZZY_FILTER_THRESHOLD})")
 
 # Apenas se rapidfuzz estiver disponível
 try:
@@ -110,7 +109,7 @@ else:
         try:
             results = process.extract(
                 ln,
-                matcher._rf_choices,
+                matcher.lexical._choices,
                 scorer=fuzz.partial_ratio,
                 limit=25
             )
@@ -119,10 +118,14 @@ else:
             continue
 
         # Filtrar por score >= 93
-        filtered = [(txt, score, key) for txt, score, key in results if score >= FUZZY_FILTER_THRESHOLD]
+        filtered = [
+            (txt, score, matcher.catalog.code(matcher.lexical._rows[pos]))
+            for txt, score, pos in results
+            if score >= FUZZY_FILTER_THRESHOLD
+        ]
 
         if not filtered:
-            print("  Nenhum match com score >= 93")
+            print(f"  Nenhum match com score >= {FUZZY_FILTER_THRESHOLD}")
             continue
 
         for txt, score, key in filtered:
@@ -132,3 +135,4 @@ else:
 header("4) Teste finalizado")
 
 print("Tudo certo. Se quiser testar outro OCR_TEXT, edite o arquivo.")
+print("Para latência e acurácia em vários documentos: python benchmarks/run.py")
@@ -4,7 +4,7 @@ Teste rápido para validar o matcher após as alterações.
 Roda no mesmo ambiente/venv/container da aplicação.
 
 Uso:
-    python debug_match_and_test.py
+    python debug_matcher_diagnostic.py
 """
 
 import sys
@@ -46,51 +46,33 @@ except Exception:
     traceback.print_exc()
     sys.exit(1)
 
-# instancia matcher
+# instancia matcher (CSV vem de PROCEDURES_CSV)
 try:
-    matcher = get_matcher(csv_path="/app/data/procedimentos.csv")
+    matcher = get_matcher()
 except Exception:
     print("Erro ao instanciar matcher via get_matcher():")
     traceback.print_exc()
     sys.exit(1)
 
+catalog = matcher.catalog
+rf_choices = matcher.lexical._choices
+
 print("\n--- Matcher basic summary ---")
-idx = getattr(matcher, "_index_by_code", None)
-descs = getattr(matcher, "_descs", None)
-rf_choices = getattr(matcher, "_rf_choices", None)
-
-print("type(_index_by_code):", type(idx).__name__)
-print("len(_index_by_code):", len(idx) if idx is not None else "N/A")
-print("len(_descs):", len(descs) if descs is not None else "N/A")
-print("_rf_choices present?:", bool(rf_choices))
-
-# quick peek at keys where target might appear (show nearby keys to target)
-if idx:
-    # print a sample of keys around where the numeric region could be
-    sample_keys = list(idx.keys())[:200]
-    print("\nSample first 120 keys (repr):")
-    for k in sample_keys[:120]:
-        print(" -", repr(k))
-
-# check whether target code is present in index_by_code
-present_direct = TARGET_CODE in (idx or {})
-present_strip = any(str(k).strip() == TARGET_CODE for k in (idx or {}))
-present_clean = any(str(k).replace("\ufeff","").replace("\u00A0","").strip() == TARGET_CODE for k in (idx or {}))
+print("len(catalog):", len(catalog))
+print("chaves léxicas (rapidfuzz):", len(rf_choices))
+print("índice:", type(matcher.index).__name__)
+
+print("\nSample first 120 codes (repr):")
+for i in range(min(120, len(catalog))):
+    print(" -", repr(catalog.code(i)), catalog.desc(i)[:80])
 
+# check whether target code is present in the catalog
 print("\nTARGET_CODE presence checks:")
-print(" - direct in keys:", present_direct)
-print(" - any str(k).strip() == TARGET_CODE:", present_strip)
-print(" - any cleaned key == TARGET_CODE:", present_clean)
-
-if present_direct or present_strip or present_clean:
-    found_key = None
-    for k in (idx or {}):
-        if str(k).strip() == TARGET_CODE or str(k).replace("\ufeff","").replace("\u00A0","").strip() == TARGET_CODE:
-            found_key = k
-            break
-    print("\nFound key repr:", repr(found_key))
-    print("Associated entry (raw):")
-    pprint(idx.get(found_key))
+print(" - has_code:", catalog.has_code(TARGET_CODE))
+
+if catalog.has_code(TARGET_CODE):
+    print("\nDescrição:")
+    pprint(catalog.desc_for_code(TARGET_CODE))
 
 # Run the matcher on your OCR_TEXT
 print("\n--- Running matcher.match_codes_from_text on OCR_TEXT ---")
@@ -120,9 +102,10 @@ if RF and rf_choices:
         if not res:
             continue
         print("\nLine:", repr(ln)[:200])
-        for text_match, score, key in res:
+        keys = [catalog.code(matcher.lexical._rows[pos]) for _, _, pos in res]
+        for (text_match, score, _), key in zip(res, keys):
             print(f" score={score:5.1f} key={repr(key)} match_text={repr(text_match)[:120]}")
-        if any(str(key).strip() == TARGET_CODE for _, _, key in res):
+        if TARGET_CODE in keys:
             print(" -> TARGET_CODE appeared in the top matches for this line.")
 else:
     print("\nrapidfuzz not available or rf_choices empty; skipping rapidfuzz diagnostics.")
@@ -1,92 +1,49 @@
-import csv
-import os
-import pickle
-import io
-import numpy as np
-import faiss
-from sentence_transformers import SentenceTransformer
-
-CSV_PATH = os.environ.get("PROCEDURES_CSV", "/app/data/procedimentos.csv")
-OUT_DIR = "/app/data/vector_index"
-MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
-
-os.makedirs(OUT_DIR, exist_ok=True)
-
-print("Loading model:", MODEL_NAME)
-model = SentenceTransformer(MODEL_NAME)
-
-procedures = []
-
-print("Reading CSV:", CSV_PATH)
+"""
+Gera (ou atualiza) o artefato de índice usado pelo matcher.
 
-# -------------------------------------------------
-# Leitura robusta de CSV (binário + decode seguro)
-# -------------------------------------------------
-with open(CSV_PATH, "rb") as f:
-    raw = f.read()
+Só as linhas novas ou com descrição alterada são codificadas; as demais
+reaproveitam os embeddings do artefato anterior. Use --full para forçar a
+recodificação de todo o catálogo.
 
-# tenta decodificar
-for enc in ("utf-8", "latin-1", "cp1252"):
-    try:
-        text = raw.decode(enc)
-        print(f"CSV decoded using: {enc}")
-        break
-    except UnicodeDecodeError:
-        continue
-else:
-    # fallback extremo (nunca quebra)
-    text = raw.decode("latin-1", errors="replace")
-    print("CSV decoded using latin-1 with replacement")
-
-# cria file-like object
-fh = io.StringIO(text)
+Uso:
+    python scripts/build_procedure_index.py [--csv PATH] [--out DIR] [--full]
+                                            [--backend torch|onnx|onnx-int8]
+"""
+import os
+import sys
+import argparse
 
-reader = csv.DictReader(fh, delimiter=";")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-for row in reader:
-    code = (
-        row.get("codigo")
-        or row.get("CODIGO")
-        or row.get("code")
-        or row.get("cod")
-    )
-    desc = (
-        row.get("descricao")
-        or row.get("DESCRICAO")
-        or row.get("description")
-        or ""
-    )
+from app.encoder import MODEL_NAME, EMBEDDING_BACKEND, BACKENDS, get_encoder
+from app.embedding_index import INDEX_DIR, build_index
 
-    if code and desc:
-        procedures.append({
-            "code": str(code).strip(),
-            "desc": desc.strip()
-        })
+CSV_PATH = os.environ.get("PROCEDURES_CSV", "/app/data/procedimentos.csv")
 
-if not procedures:
-    raise RuntimeError("Nenhum procedimento carregado do CSV")
 
-texts = [p["desc"] for p in procedures]
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--csv", default=CSV_PATH)
+    parser.add_argument("--out", default=INDEX_DIR)
+    parser.add_argument("--full", action="store_true",
+                        help="recodifica todo o catálogo, ignorando o artefato anterior")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=BACKENDS,
+                        help="deve ser o mesmo EMBEDDING_BACKEND do matcher")
+    args = parser.parse_args()
 
-print(f"Generating embeddings for {len(texts)} procedures...")
-embeddings = model.encode(
-    texts,
-    convert_to_numpy=True,
-    show_progress_bar=True,
-    normalize_embeddings=True
-).astype("float32")
+    os.makedirs(args.out, exist_ok=True)
 
-dim = embeddings.shape[1]
+    print("Loading model:", MODEL_NAME, f"({args.backend})")
+    encoder = get_encoder(args.backend)
 
-print("Building FAISS index...")
-index = faiss.IndexHNSWFlat(dim, 32)
-index.hnsw.efConstruction = 200
-index.add(embeddings)
+    print("Reading CSV:", args.csv)
+    manifest = build_index(args.csv, encoder, index_dir=args.out, full=args.full)
 
-print("Saving index...")
-faiss.write_index(index, f"{OUT_DIR}/procedures.index")
+    print(
+        f"DONE. Índice criado com sucesso: {manifest['count']} procedimentos "
+        f"({manifest['encoded']} codificados, {manifest['reused']} reaproveitados)."
+    )
 
-with open(f"{OUT_DIR}/procedures_meta.pkl", "wb") as f:
-    pickle.dump(procedures, f)
 
-print("DONE. Index criado com sucesso.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import re
+import zlib
+
+import numpy as np
+import pytest
+
+from app.catalog import normalize_text
+from app.lexical import BOILERPLATE_SUFFIX
+from app.match_cache import MatchCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCEDURES_CSV = os.path.join(ROOT, "data", "procedimentos.csv")
+
+DIM = 1024
+
+
+class HashEncoder:
+    """
+    Dublê do encoder: bag-of-words com hash das palavras da linha
+    normalizada (sem o sufixo genérico da tabela). Mesma interface de
+    TorchEncoder/OnnxEncoder, sem modelo.
+    """
+
+    backend = "test"
+    id = "test-hash-bow"
+
+    def __init__(self):
+        self.calls = []
+
+    def vector(self, text: str):
+        core = BOILERPLATE_SUFFIX.sub("", normalize_text(text))
+        v = np.zeros(DIM, dtype=np.float32)
+        for word in re.findall(r"\w+", core):
+            v[zlib.crc32(word.encode("utf-8")) % DIM] += 1.0
+        return v
+
+    def encode(self, texts, batch_size: int = 64, normalize: bool = True,
+               show_progress_bar: bool = False):
+        texts = list(texts)
+        self.calls.append(texts)
+
+        emb = np.stack([self.vector(t) for t in texts]) if texts else np.zeros((0, DIM), np.float32)
+        if normalize:
+            emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb
+
+    @property
+    def encoded(self):
+        return [t for call in self.calls for t in call]
+
+
+@pytest.fixture(scope="session")
+def index_dir(tmp_path_factory):
+    # o índice do catálogo real é montado uma vez por sessão
+    return str(tmp_path_factory.mktemp("vector_index"))
+
+
+@pytest.fixture
+def make_matcher(monkeypatch, index_dir):
+    import app.matcher as matcher_module
+
+    def make(csv_path=PROCEDURES_CSV, encoder=None, directory=None):
+        monkeypatch.setattr(matcher_module, "get_encoder", lambda: encoder or HashEncoder())
+        monkeypatch.setattr(matcher_module, "INDEX_DIR", directory or index_dir)
+        monkeypatch.setattr(matcher_module, "RELOAD_INTERVAL", 0)
+
+        matcher = matcher_module.ProcedureMatcher(csv_path)
+        # cache próprio por teste: nada de decisões de outro teste
+        matcher.cache = MatchCache(redis_url=None)
+        matcher.encoder.calls.clear()
+        return matcher
+
+    return make
+
+
+@pytest.fixture
+def matcher(make_matcher):
+    return make_matcher()
@@ -0,0 +1,80 @@
+import pytest
+
+from app.catalog import MAGIC, ProcedureCatalog, normalize_text
+
+RECORDS = [
+    ("40301591", "Colesterol (LDL) - pesquisa e/ou dosagem"),
+    ("40301087", "Ácido fólico, pesquisa e/ou dosagem nos eritrócitos"),
+    ("40301087", "ACIDO FOLICO, pesquisa e/ou dosagem nos eritrocitos"),  # só caixa/acentos
+    ("40301087", "Ácido fólico, pesquisa e/ou dosagem nos eritrócitos"),  # duplicata exata
+    ("40316548", "Tiroxina (T4) - pesquisa e/ou dosagem"),
+    ("40316548", "T4 total"),  # mesmo código, outra descrição
+    ("10101012", "Consulta em consultório (no horário normal ou preestabelecido)"),
+]
+
+
+@pytest.fixture
+def saved(tmp_path):
+    path = str(tmp_path / "catalog.bin")
+    ProcedureCatalog.from_records(RECORDS).save(path)
+    return path
+
+
+def rows(catalog):
+    return [catalog[i] for i in range(len(catalog))]
+
+
+def test_dedupe_by_code_and_normalized_desc():
+    catalog = ProcedureCatalog.from_records(RECORDS)
+
+    assert rows(catalog) == [
+        ("40301591", "Colesterol (LDL) - pesquisa e/ou dosagem"),
+        ("40301087", "Ácido fólico, pesquisa e/ou dosagem nos eritrócitos"),
+        ("40316548", "Tiroxina (T4) - pesquisa e/ou dosagem"),
+        ("40316548", "T4 total"),
+        ("10101012", "Consulta em consultório (no horário normal ou preestabelecido)"),
+    ]
+
+
+def test_round_trip_keeps_non_ascii(saved):
+    original = ProcedureCatalog.from_records(RECORDS)
+    loaded = ProcedureCatalog.load(saved)
+
+    assert len(loaded) == len(original)
+    assert rows(loaded) == rows(original)
+    assert [loaded.norm_desc(i) for i in range(len(loaded))] == [
+        normalize_text(desc) for _, desc in rows(original)
+    ]
+    # offsets em bytes UTF-8, não em caracteres
+    assert loaded.desc(1) == "Ácido fólico, pesquisa e/ou dosagem nos eritrócitos"
+    assert loaded.desc_for_code("10101012").endswith("(no horário normal ou preestabelecido)")
+
+
+def test_round_trip_code_lookup(saved):
+    loaded = ProcedureCatalog.load(saved)
+
+    assert loaded.has_code("40316548")
+    assert loaded.desc_for_code("40316548") == "Tiroxina (T4) - pesquisa e/ou dosagem"
+    assert not loaded.has_code("99999999")
+    assert not loaded.has_code("4031654800000")  # maior que a largura dos códigos
+
+
+def test_rejects_other_version(saved):
+    with open(saved, "r+b") as f:
+        f.write(MAGIC.replace(b"v1", b"v2"))
+
+    with pytest.raises(ValueError):
+        ProcedureCatalog.load(saved)
+
+
+# vazio, no MAGIC, no header e no meio dos arrays
+@pytest.mark.parametrize("fraction", [0, 0.01, 0.05, 0.5, 0.9])
+def test_rejects_truncated_file(saved, fraction):
+    with open(saved, "rb") as f:
+        data = f.read()
+
+    with open(saved, "wb") as f:
+        f.write(data[:int(len(data) * fraction)])
+
+    with pytest.raises(ValueError):
+        ProcedureCatalog.load(saved)
@@ -0,0 +1,56 @@
+import asyncio
+
+from app.matcher import MatchResult
+from app.match_server import MicroBatcher
+
+
+class FakeMatcher:
+    """match_many que falha se qualquer texto do lote for "quebra"."""
+
+    def __init__(self):
+        self.batches = []
+
+    def match_many(self, texts):
+        self.batches.append(list(texts))
+        if "quebra" in texts:
+            raise ValueError("texto inválido")
+        return [MatchResult([text], [], "v1") for text in texts]
+
+
+async def submit_all(batcher, requests):
+    results = await asyncio.gather(
+        *(batcher.submit(texts) for texts in requests), return_exceptions=True
+    )
+    await batcher.close()
+    return results
+
+
+def test_requests_share_one_batch():
+    matcher = FakeMatcher()
+
+    async def run():
+        batcher = MicroBatcher(matcher, max_batch=64, max_wait=0.05)
+        return await submit_all(batcher, [["a"], ["b", "c"], ["d"]])
+
+    results = asyncio.run(run())
+
+    assert [[r.codes for r in item] for item in results] == [[["a"]], [["b"], ["c"]], [["d"]]]
+    assert matcher.batches == [["a", "b", "c", "d"]]
+
+
+def test_failing_text_only_fails_its_request():
+    matcher = FakeMatcher()
+
+    async def run():
+        batcher = MicroBatcher(matcher, max_batch=64, max_wait=0.05)
+        return await submit_all(batcher, [["a"], ["quebra", "b"], ["c"]])
+
+    ok_a, failed, ok_c = asyncio.run(run())
+
+    assert isinstance(failed, ValueError)
+    assert [r.codes for r in ok_a] == [["a"]]
+    assert [r.codes for r in ok_c] == [["c"]]
+    # lote inteiro primeiro, depois uma tentativa por requisição
+    assert matcher.batches[0] == ["a", "quebra", "b", "c"]
+    assert matcher.batches[1:] == [["a"], ["quebra", "b"], ["c"]]
+
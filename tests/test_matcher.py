@@ -0,0 +1,165 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.matcher import THRESHOLD
+
+from tests.conftest import HashEncoder
+
+
+class AliasEncoder(HashEncoder):
+    """Codifica certas linhas como se fossem outro texto."""
+
+    def __init__(self, aliases):
+        super().__init__()
+        self.aliases = aliases
+
+    def vector(self, text: str):
+        return super().vector(self.aliases.get(text, text))
+
+
+def last_decision(result):
+    return result.trace[-1]
+
+
+# =========================================================
+# Regra contains — conter o termo não dispensa o modelo
+# =========================================================
+def test_multiword_contains_goes_to_model(matcher):
+    # só "Colesterol LDL peroxidada" contém "colesterol ldl"; o pedido é
+    # o "Colesterol (LDL) - pesquisa e/ou dosagem"
+    result = matcher.match("Colesterol LDL")
+
+    assert result.codes == ["40301591"]
+    assert "40322459" not in result.codes
+    assert matcher.encoder.encoded == ["Colesterol LDL"]
+
+
+def test_single_container_is_not_accepted_without_score(matcher):
+    # "nos eritrócitos" é a única descrição com "acido folico"
+    result = matcher.match("Acido folico")
+    decision = last_decision(result)
+
+    assert matcher.encoder.encoded == ["Acido folico"]
+    assert decision["score"] is not None
+    assert decision["stage"] in ("rule_contains", "embeddings")
+
+
+def test_contains_accepts_only_model_top1(make_matcher):
+    # top-1 fora das descrições que contêm o termo: vale o threshold
+    matcher = make_matcher(encoder=AliasEncoder({"Acido folico": "Acido urico dosagem"}))
+    result = matcher.match("Acido folico")
+    decision = last_decision(result)
+
+    assert decision["candidate"]["code"] != "40301087"
+    assert decision["stage"] == "embeddings"
+    assert decision["accepted"] == (decision["score"] >= THRESHOLD)
+
+
+def test_defined_acronym_skips_model(matcher):
+    result = matcher.match("TSH")
+    decision = last_decision(result)
+
+    assert result.codes == ["40316521"]
+    assert decision["stage"] == "rule_contains"
+    assert decision["score"] is None
+    assert matcher.encoder.encoded == []
+
+
+# =========================================================
+# Chamadas concorrentes — lotes compartilhados
+# =========================================================
+AMBIGUOUS_LINES = [
+    "Colesterol LDL",
+    "Acido folico",
+    "Hemograma completo",
+    "Glicose jejum",
+    "Ureia sangue",
+    "Creatinina serica",
+    "Urina tipo 1",
+    "Vitamina D 25 hidroxi",
+    "Ferritina serica",
+    "Triglicerides sangue",
+    "Colesterol total e fracoes",
+    "Acido urico sangue",
+]
+
+POISON = "linha que derruba o encoder"
+
+
+class SlowEncoder(HashEncoder):
+    """Segura cada encode um pouco (as chamadas se acumulam) e falha no POISON."""
+
+    delay = 0.0
+
+    def encode(self, texts, *args, **kwargs):
+        texts = list(texts)
+        time.sleep(self.delay)
+        if POISON in texts:
+            self.calls.append(texts)
+            raise RuntimeError("encoder quebrou")
+        return super().encode(texts, *args, **kwargs)
+
+
+def summary(result):
+    return result.codes, [
+        (d.get("stage"), d.get("candidate", {}).get("code"), d.get("accepted"))
+        for d in result.trace
+    ]
+
+
+@pytest.fixture
+def slow_matcher(make_matcher):
+    matcher = make_matcher(encoder=SlowEncoder())
+    matcher.cache = None  # toda chamada passa pelo encoder
+    return matcher
+
+
+def test_concurrent_match_equals_sequential(slow_matcher):
+    expected = [summary(slow_matcher.match(text)) for text in AMBIGUOUS_LINES]
+
+    slow_matcher.encoder.calls.clear()
+    slow_matcher.encoder.delay = 0.05
+    with ThreadPoolExecutor(len(AMBIGUOUS_LINES)) as pool:
+        got = [summary(r) for r in pool.map(slow_matcher.match, AMBIGUOUS_LINES)]
+
+    assert got == expected
+    # as chamadas foram de fato agrupadas
+    assert len(slow_matcher.encoder.calls) < len(AMBIGUOUS_LINES)
+
+
+def test_failing_text_only_fails_its_caller(slow_matcher):
+    expected = {text: summary(slow_matcher.match(text)) for text in AMBIGUOUS_LINES}
+
+    slow_matcher.encoder.calls.clear()
+    slow_matcher.encoder.delay = 0.05
+    texts = AMBIGUOUS_LINES[:6] + [POISON] + AMBIGUOUS_LINES[6:]
+
+    with ThreadPoolExecutor(len(texts)) as pool:
+        futures = {text: pool.submit(slow_matcher.match, text) for text in texts}
+
+    with pytest.raises(RuntimeError):
+        futures[POISON].result()
+
+    for text in AMBIGUOUS_LINES:
+        assert summary(futures[text].result()) == expected[text]
+
+    # o POISON saiu num lote com outras linhas antes da repetição isolada
+    assert any(POISON in call and len(call) > 1 for call in slow_matcher.encoder.calls)
+
+
+# =========================================================
+# Cache e deduplicação pela linha exata enviada ao modelo
+# =========================================================
+def test_variants_are_encoded_and_cached_separately(matcher):
+    first = matcher.match("Colesterol LDL\nCOLESTEROL LDL\nColesterol LDL")
+
+    assert matcher.encoder.encoded == ["Colesterol LDL", "COLESTEROL LDL"]
+    assert not any(d.get("cached") for d in first.trace)
+
+    matcher.encoder.calls.clear()
+    second = matcher.match("COLESTEROL LDL\nColesterol ldl")
+
+    assert matcher.encoder.encoded == ["Colesterol ldl"]
+    assert [d.get("cached", False) for d in second.trace[1:]] == [True, False]